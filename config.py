@@ -1,5 +1,7 @@
 """Reading config file."""
+import os
 import yaml
 
-with open("config.yaml", "r") as f:
+# NEATO_CONFIG can point to another config file than config.yaml
+with open(os.environ.get("NEATO_CONFIG", "config.yaml"), "r") as f:
     settings = yaml.safe_load(f)
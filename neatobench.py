@@ -0,0 +1,259 @@
+"""Benchmarks of command latency, poll cycles and parsing.
+
+Runs against the simulator (see neatosim.py) in a separate process, so the
+CPU time measured is that of the client only:
+
+    python3 neatobench.py --latency 0.01 --jitter 0.005 --json bench.json
+
+or against a session recorded with the record transport (see
+neatotransport.py), replayed as fast as possible unless --replay-speed is
+given:
+
+    python3 neatobench.py --replay session.jsonl
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+import yaml
+
+# commands a poll cycle of neatoserialmqtt is derived from
+POLL_COMMANDS = ['GetCharger', 'GetMotors', 'GetErr', 'GetVersion']
+
+
+def run_simulator(conn, latency, jitter, seed):
+    """Run a simulator and send its port through conn until told to stop."""
+    from neatosim import NeatoSimulator
+    sim = NeatoSimulator(latency=latency, jitter=jitter, seed=seed,
+                         unplug_gap=float('inf'))
+    conn.send(sim.start())
+    conn.recv()
+    sim.stop()
+
+
+def summarize(name, latencies, cpu, commands, bytes_in, bytes_out):
+    """Return the statistics of a scenario as a dictionary."""
+    elapsed = sum(latencies)
+    if len(latencies) > 1:
+        q = statistics.quantiles(latencies, n=100, method='inclusive')
+        p50, p95, p99 = q[49], q[94], q[98]
+    else:
+        p50 = p95 = p99 = latencies[0]
+    return {
+        'scenario': name,
+        'iterations': len(latencies),
+        'p50_ms': p50 * 1000,
+        'p95_ms': p95 * 1000,
+        'p99_ms': p99 * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'commands_per_second': commands / elapsed if elapsed else 0.0,
+        'bytes_in_per_second': bytes_in / elapsed if elapsed else 0.0,
+        'bytes_out_per_second': bytes_out / elapsed if elapsed else 0.0,
+        'cpu_ms_per_iteration': cpu / len(latencies) * 1000,
+    }
+
+
+def measure(name, func, iterations, commands_per_iteration=1,
+            bytes_out_per_iteration=0, received=None):
+    """Time func over iterations and summarize the results.
+
+    received is called after every iteration and returns the number of
+    bytes received during it.
+    """
+    latencies = []
+    bytes_in = 0
+    cpu_start = time.process_time()
+    for i in range(iterations):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+        if received is not None:
+            bytes_in += received()
+    cpu = time.process_time() - cpu_start
+    return summarize(name, latencies, cpu,
+                     commands_per_iteration * iterations, bytes_in,
+                     bytes_out_per_iteration * iterations)
+
+
+def bench_serial(ns, iterations, replay=False):
+    """Benchmark scenarios that talk to the simulator.
+
+    When replaying a recording, only the poll cycles are run, the lidar and
+    reconnects are unlikely to be in there.
+    """
+    # bytes of the last response(s), plus their terminators
+    def received(count=1):
+        return lambda: ns.rxlen + count
+
+    ns.write("wake-up")
+    results = [measure('write GetCharger',
+                       lambda: ns.write("GetCharger"), iterations,
+                       bytes_out_per_iteration=len("GetCharger\n"),
+                       received=received())]
+
+    def poll_cycle():
+        with ns.poll():
+            ns.batch(POLL_COMMANDS)
+            ns.getSerialNumber()
+            ns.getSoftwareVersion()
+            ns.getExtPwrPresent()
+            ns.getCleaning()
+            ns.getChargingActive()
+            ns.getVacuumRPM()
+            ns.getBatteryLevel()
+            ns.getError()
+    results.append(measure(
+        'poll cycle (batched)', poll_cycle, iterations,
+        commands_per_iteration=len(POLL_COMMANDS),
+        bytes_out_per_iteration=len('\n'.join(POLL_COMMANDS)) + 1,
+        received=received(len(POLL_COMMANDS))))
+
+    def poll_cycle_sequential():
+        ns.version = None
+        with ns.poll():
+            for command in POLL_COMMANDS:
+                ns.query(command)
+    results.append(measure(
+        'poll cycle (sequential)', poll_cycle_sequential, iterations,
+        commands_per_iteration=len(POLL_COMMANDS),
+        bytes_out_per_iteration=len('\n'.join(POLL_COMMANDS)) + 1))
+    if replay:
+        return results
+
+    ns.startLDS()
+    results.append(measure('getLDSScan', ns.getLDSScan, iterations,
+                           bytes_out_per_iteration=len("GetLDSScan\n"),
+                           received=received()))
+    ns.stopLDS()
+    results.append(measure('reconnect', ns.reconnect,
+                           max(1, iterations // 50)))
+    return results
+
+
+def recorded_responses(path):
+    """Return the last recorded response to every command with a parser."""
+    from neatoparsers import PARSERS
+    from neatotransport import load
+    responses = {}
+    for stamp, request, response, latency in load(path):
+        # batches are recorded as one exchange, split them up
+        for raw in response.split(b'\x1a'):
+            echo = raw.lstrip().split(b'\r\n', 1)[0].strip().decode(
+                'utf-8', 'replace')
+            if echo in PARSERS and raw.strip() != echo.encode('utf-8'):
+                responses[echo] = raw.lstrip()
+    return responses
+
+
+def bench_parsers(ns, iterations, responses=None):
+    """Benchmark parsing of large responses, without any serial traffic.
+
+    responses maps commands to their raw responses, like the ones of
+    recorded_responses(), and defaults to responses of the simulator.
+    """
+    from neatoparsers import parse
+    if responses is None:
+        from neatosim import NeatoSimulator
+        sim = NeatoSimulator(seed=1)
+        sim.testMode = sim.ldsRotating = True
+        responses = {
+            command: (command + '\r\n' + body).encode('utf-8')
+            for command, body in (
+                ('GetLDSScan', sim.getLDSScan()),
+                ('GetAnalogSensors', sim.getAnalogSensors()),
+                ('GetCharger', sim.getCharger()),
+                ('GetVersion', sim.getVersion()))}
+    results = []
+    for command, raw in responses.items():
+        results.append(measure('parse ' + command,
+                               lambda: parse(command, raw), iterations))
+        text = raw.decode('utf-8')
+        results.append(measure('parseOutput ' + command,
+                               lambda: ns.parseOutput(text), iterations))
+    return results
+
+
+def print_results(results):
+    """Print results as a table."""
+    print('%-28s %6s %9s %9s %9s %9s %10s' % (
+        'scenario', 'n', 'p50 ms', 'p95 ms', 'p99 ms', 'cmd/s', 'cpu ms'))
+    for r in results:
+        print('%-28s %6d %9.3f %9.3f %9.3f %9.1f %10.3f' % (
+            r['scenario'], r['iterations'], r['p50_ms'], r['p95_ms'],
+            r['p99_ms'], r['commands_per_second'],
+            r['cpu_ms_per_iteration']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--parse-iterations', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='simulated seconds before each response')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='simulated random extra seconds per response')
+    parser.add_argument('--framing', default='terminator',
+                        choices=['terminator', 'sleep'])
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--replay', default=None,
+                        help='replay this recorded session instead of '
+                        'running the simulator')
+    parser.add_argument('--replay-speed', type=float, default=0.0,
+                        help='replay this many times faster than recorded, '
+                        '0 for no delays at all')
+    parser.add_argument('--json', default=None,
+                        help='also write the results to this file')
+    args = parser.parse_args()
+
+    config = {'serial': {'timeout_seconds': 0.1,
+                         'usb_switch_mode': 'none',
+                         'reboot_after_usb_switch': False,
+                         'response_framing': args.framing}}
+    if args.replay:
+        simulator = None
+        config['serial'].update({'transport': 'replay',
+                                 'transport_file': args.replay,
+                                 'replay_speed': args.replay_speed})
+    else:
+        ours, theirs = multiprocessing.Pipe()
+        simulator = multiprocessing.Process(
+            target=run_simulator,
+            args=(theirs, args.latency, args.jitter, args.seed), daemon=True)
+        simulator.start()
+        config['serial']['serial_device'] = ours.recv()
+
+    # NeatoSerial reads its settings from the config file at import
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml',
+                                     delete=False) as f:
+        yaml.safe_dump(config, f)
+    os.environ['NEATO_CONFIG'] = f.name
+    try:
+        from neatoserial import NeatoSerial
+        # the tracing prints of NeatoSerial would dominate the results
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            ns = NeatoSerial()
+            results = bench_serial(ns, args.iterations, bool(args.replay))
+            results += bench_parsers(
+                ns, args.parse_iterations,
+                recorded_responses(args.replay) if args.replay else None)
+            ns.close()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+    finally:
+        os.remove(f.name)
+        if simulator is not None:
+            ours.send('stop')
+            simulator.join()
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f,
+                      indent=2)
@@ -0,0 +1,175 @@
+"""Non-blocking Clean workflow for Neato."""
+import logging
+import random
+import threading
+import time
+from neatoworker import PRIORITY_COMMAND
+
+# states of the workflow, in the order they are passed through
+IDLE = 'idle'
+SENDING = 'sending'
+USB_OFF = 'usb_off'
+REENUMERATING = 'reenumerating'
+SETTLING = 'settling'
+VERIFYING = 'verifying'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class CleanWorkflow:
+    """Send Clean commands and toggle USB without holding up the worker.
+
+    Neato only starts cleaning once its USB connection is gone, so a Clean
+    command goes through these states:
+
+        sending -> usb_off -> reenumerating -> settling -> verifying -> done
+
+    Every state does one short job on the SerialWorker and the waits in
+    between run on timers, so commands and telemetry keep flowing. If
+    GetMotors shows Neato did not start (or stop) cleaning, the command is
+    sent again, up to clean_retries times, before the workflow fails.
+    Listeners are called with the progress after every state change:
+
+        workflow = CleanWorkflow(worker, settings['serial'])
+        workflow.listeners.append(lambda progress: print(progress))
+        workflow.start("Clean")
+    """
+
+    def __init__(self, worker, config):
+        """Initialize workflow running its steps on a SerialWorker."""
+        self.log = logging.getLogger(__name__)
+        self.worker = worker
+        self.usb_off = float(config.get('usb_off_seconds', 1))
+        self.settle = float(config.get('clean_settle_seconds', 10))
+        self.retries = int(config.get('clean_retries', 1))
+        self.lock = threading.Lock()
+        # bumped by start() and cancel(), steps of older runs are dropped
+        self.generation = 0
+        self.timer = None
+        self.state = IDLE
+        self.msg = None
+        self.attempt = 0
+        self.detail = None
+        self.deadline = None
+        self.delay = None
+        self.listeners = []
+
+    def start(self, msg):
+        """Start the workflow for a Clean command, replacing a running one."""
+        with self.lock:
+            generation = self.cancelTimer()
+            self.msg = msg
+            self.attempt = 0
+        self.step(generation, self.send)
+
+    def cancel(self):
+        """Stop a running workflow."""
+        with self.lock:
+            self.cancelTimer()
+        self.report(IDLE)
+
+    def cancelTimer(self):
+        """Cancel the pending timer and return the next generation."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.generation += 1
+        return self.generation
+
+    def running(self):
+        """Return if a workflow is in progress."""
+        return self.state not in (IDLE, DONE, FAILED)
+
+    def progress(self):
+        """Return the progress as a dictionary."""
+        return {'state': self.state, 'command': self.msg,
+                'attempt': self.attempt, 'detail': self.detail}
+
+    def report(self, state, detail=None):
+        """Enter state and tell the listeners."""
+        self.state = state
+        self.detail = detail
+        self.log.debug("Clean workflow: "+state
+                       + (" ("+detail+")" if detail else ""))
+        if state in (DONE, FAILED):
+            self.worker.neato.metrics.inc('neato_clean_workflows_total',
+                                          result=state)
+        progress = self.progress()
+        for listener in self.listeners:
+            try:
+                listener(progress)
+            except Exception as ex:
+                self.log.error("Exception in clean listener: "+str(ex))
+
+    def step(self, generation, func, delay=0):
+        """Run func(neato, generation) on the worker after delay seconds.
+
+        Nothing is run once the workflow was restarted or cancelled.
+        """
+        def run(neato):
+            if generation != self.generation:
+                return
+            try:
+                func(neato, generation)
+            except Exception as ex:
+                self.report(FAILED, str(ex))
+                raise
+
+        def submit():
+            self.worker.submit(run, PRIORITY_COMMAND)
+
+        if delay <= 0:
+            submit()
+            return
+        with self.lock:
+            if generation == self.generation:
+                self.timer = threading.Timer(delay, submit)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def send(self, neato, generation):
+        """Send the command and switch USB off."""
+        self.attempt += 1
+        self.report(SENDING)
+        neato.write(self.msg, toggle=False)
+        self.report(USB_OFF)
+        # the device goes away with the usb connection
+        neato.close()
+        neato.switchUsb(False)
+        self.step(generation, self.usbOn, self.usb_off)
+
+    def usbOn(self, neato, generation):
+        """Switch USB back on and start waiting for Neato."""
+        neato.switchUsb(True)
+        neato.metrics.inc('neato_reconnects_total')
+        self.report(REENUMERATING)
+        self.deadline = time.monotonic() + neato.reconnect_timeout
+        self.delay = neato.reconnect_initial
+        self.reconnect(neato, generation)
+
+    def reconnect(self, neato, generation):
+        """Try to connect, with backoff like NeatoSerial.reconnect."""
+        if not neato.isConnected:
+            neato.isConnected = neato.connect()
+        if neato.isConnected:
+            self.report(SETTLING)
+            self.step(generation, self.verify, self.settle)
+        elif time.monotonic() < self.deadline:
+            self.step(generation, self.reconnect,
+                      random.uniform(0, self.delay))
+            self.delay = min(self.delay * 2, neato.reconnect_max)
+        else:
+            self.report(FAILED, "Neato did not come back after the USB "
+                        + "toggle")
+
+    def verify(self, neato, generation):
+        """Check with GetMotors if the command took effect, retry if not."""
+        self.report(VERIFYING)
+        expected = self.msg != "Clean Stop"
+        if neato.getCleaning() == expected:
+            self.report(DONE)
+        elif self.attempt <= self.retries:
+            self.log.debug("Neato did not react to "+self.msg+", retrying")
+            self.send(neato, generation)
+        else:
+            self.report(FAILED, "Neato did not react to "+self.msg)
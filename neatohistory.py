@@ -0,0 +1,414 @@
+"""On-disk telemetry history of battery, motors and sensors.
+
+Samples of GetCharger, GetMotors, GetAnalogSensors and GetDigitalSensors are
+stored as fixed-width records in segment files of a fixed number of
+records. A segment is allocated once and filled through a memory map, full
+segments are never written again and the oldest are deleted, so disk use
+is bounded and nothing is rewritten. Query a history with:
+
+    python3 neatohistory.py /var/lib/neato/history --every 3600 \\
+        --columns fuel_percent,vbatt_v
+"""
+import argparse
+import datetime
+import glob
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+import numpy as np
+from neatoworker import PRIORITY_TELEMETRY
+
+MAGIC = b'NTHS'
+VERSION = 1
+# records start at the first page, the header holds the columns as JSON
+HEADER_SIZE = 4096
+
+# below telemetry, history samples wait for everything else
+PRIORITY_HISTORY = PRIORITY_TELEMETRY + 10
+
+# column -> (command, label in the parsed output)
+COLUMNS = {
+    'fuel_percent': ('GetCharger', 'FuelPercent'),
+    'charging_active': ('GetCharger', 'ChargingActive'),
+    'ext_pwr_present': ('GetCharger', 'ExtPwrPresent'),
+    'batt_temp_c': ('GetCharger', 'BattTempCAvg[0]'),
+    'vbatt_v': ('GetCharger', 'VBattV'),
+    'vext_v': ('GetCharger', 'VExtV'),
+    'charger_mah': ('GetCharger', 'Charger_mAH'),
+    'discharge_mah': ('GetCharger', 'Discharge_mAH'),
+    'brush_rpm': ('GetMotors', 'Brush_RPM'),
+    'brush_ma': ('GetMotors', 'Brush_mA'),
+    'vacuum_rpm': ('GetMotors', 'Vacuum_RPM'),
+    'vacuum_ma': ('GetMotors', 'Vacuum_mA'),
+    'side_brush_ma': ('GetMotors', 'SideBrush_mA'),
+    'left_wheel_rpm': ('GetMotors', 'LeftWheel_RPM'),
+    'left_wheel_load': ('GetMotors', 'LeftWheel_Load%'),
+    'left_wheel_mm': ('GetMotors', 'LeftWheel_PositionInMM'),
+    'right_wheel_rpm': ('GetMotors', 'RightWheel_RPM'),
+    'right_wheel_load': ('GetMotors', 'RightWheel_Load%'),
+    'right_wheel_mm': ('GetMotors', 'RightWheel_PositionInMM'),
+    'battery_voltage_mv': ('GetAnalogSensors', 'BatteryVoltage'),
+    'battery_current_ma': ('GetAnalogSensors', 'BatteryCurrent'),
+    'battery_temp_mc': ('GetAnalogSensors', 'BatteryTemperature'),
+    'external_voltage_mv': ('GetAnalogSensors', 'ExternalVoltage'),
+    'vacuum_current_ma': ('GetAnalogSensors', 'VacuumCurrent'),
+    'side_brush_current_ma': ('GetAnalogSensors', 'SideBrushCurrent'),
+    'wall_mm': ('GetAnalogSensors', 'WallSensor'),
+    'drop_left_mm': ('GetAnalogSensors', 'DropSensorLeft'),
+    'drop_right_mm': ('GetAnalogSensors', 'DropSensorRight'),
+    'dc_jack_in': ('GetDigitalSensors', 'SNSR_DC_JACK_IS_IN'),
+    'dustbin_in': ('GetDigitalSensors', 'SNSR_DUSTBIN_IS_IN'),
+    'left_wheel_extended': ('GetDigitalSensors', 'SNSR_LEFT_WHEEL_EXTENDED'),
+    'right_wheel_extended': ('GetDigitalSensors',
+                             'SNSR_RIGHT_WHEEL_EXTENDED'),
+    'bumper_left_side': ('GetDigitalSensors', 'LSIDEBIT'),
+    'bumper_left_front': ('GetDigitalSensors', 'LFRONTBIT'),
+    'bumper_right_side': ('GetDigitalSensors', 'RSIDEBIT'),
+    'bumper_right_front': ('GetDigitalSensors', 'RFRONTBIT'),
+}
+
+# the commands a sample is taken from
+COMMANDS = ['GetCharger', 'GetMotors', 'GetAnalogSensors',
+            'GetDigitalSensors']
+
+
+def record_dtype(columns):
+    """Return the record type: a time and a float32 (NaN if missing) each."""
+    return np.dtype([('time', '<f8')] + [(c, '<f4') for c in columns])
+
+
+def to_row(outputs):
+    """Convert parsed command outputs to a dictionary of column values."""
+    row = {}
+    for column, (command, label) in COLUMNS.items():
+        value = (outputs.get(command) or {}).get(label)
+        # analog sensors are Measurements of value and unit
+        value = getattr(value, 'value', value)
+        if isinstance(value, (int, float)):
+            row[column] = value
+    return row
+
+
+class Segment:
+    """One segment file of fixed-width records, filled through an mmap."""
+
+    def __init__(self, path, columns=None, capacity=None):
+        """Open a segment, or create it if columns and capacity are given."""
+        self.path = path
+        if columns is not None and not os.path.exists(path):
+            header = json.dumps({'columns': list(columns),
+                                 'capacity': capacity}).encode('utf-8')
+            with open(path, 'wb') as f:
+                f.write(MAGIC + bytes([VERSION]) + header)
+                # allocated once, sparse until written
+                f.truncate(HEADER_SIZE + record_dtype(columns).itemsize
+                           * capacity)
+        with open(path, 'rb') as f:
+            head = f.read(HEADER_SIZE)
+        if head[:4] != MAGIC:
+            raise ValueError(path + " is not a history segment")
+        meta = json.loads(head[5:].rstrip(b'\0').decode('utf-8'))
+        self.columns = meta['columns']
+        self.capacity = meta['capacity']
+        self.dtype = record_dtype(self.columns)
+        self.map = None
+        self.records = np.memmap(path, dtype=self.dtype, mode='r',
+                                 offset=HEADER_SIZE, shape=(self.capacity,))
+        # unwritten records have time 0
+        empty = np.flatnonzero(self.records['time'] == 0)
+        self.count = int(empty[0]) if len(empty) else self.capacity
+
+    def openForWriting(self):
+        """Map the segment writable."""
+        with open(self.path, 'r+b') as f:
+            self.map = mmap.mmap(f.fileno(), 0)
+        self.records = np.frombuffer(self.map, dtype=self.dtype,
+                                     count=self.capacity,
+                                     offset=HEADER_SIZE)
+
+    def full(self):
+        """Return if no record is left."""
+        return self.count >= self.capacity
+
+    def last(self):
+        """Return the time of the last record, or 0."""
+        if not self.count:
+            return 0.0
+        return float(self.records['time'][self.count - 1])
+
+    def append(self, stamp, row):
+        """Write the next record."""
+        self.records[self.count] = (stamp,) + tuple(
+            row.get(column, np.nan) for column in self.columns)
+        self.count += 1
+
+    def range(self, start, end):
+        """Return a view on the records with start <= time < end."""
+        times = self.records['time'][:self.count]
+        first, last = np.searchsorted(times, [start, end])
+        return self.records[first:last]
+
+    def flush(self):
+        """Write changed pages to disk."""
+        if self.map is not None:
+            self.map.flush()
+
+    def close(self):
+        """Flush and unmap the segment."""
+        self.flush()
+        self.records = None
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class TelemetryHistory:
+    """Append-only telemetry history in rotating segment files.
+
+        history = TelemetryHistory('/var/lib/neato/history')
+        history.record({'GetCharger': ns.getCharger(), ...})
+        hourly = history.downsample(3600, columns=['fuel_percent'])
+
+    At most segments files of segment_records records each are kept.
+    Changes are flushed to disk every flush_seconds, the page cache holds
+    them until then, so frequent samples do not wear an SD card down
+    page by page.
+    """
+
+    def __init__(self, directory, segment_records=65536, segments=16,
+                 flush_seconds=30):
+        """Open the history in directory, creating it if needed."""
+        self.log = logging.getLogger(__name__)
+        self.directory = directory
+        self.segment_records = int(segment_records)
+        self.segments = int(segments)
+        self.flush_seconds = float(flush_seconds)
+        self.lock = threading.Lock()
+        self.columns = list(COLUMNS)
+        self.current = None
+        self.lastFlush = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+        paths = self.paths()
+        if paths:
+            segment = Segment(paths[-1])
+            if not segment.full() and segment.columns == self.columns:
+                segment.openForWriting()
+                self.current = segment
+
+    def paths(self):
+        """Return the segment files, oldest first."""
+        return sorted(glob.glob(os.path.join(self.directory,
+                                             'telemetry-*.bin')))
+
+    def rotate(self):
+        """Start a new segment and delete the oldest ones beyond segments."""
+        if self.current is not None:
+            self.current.close()
+        paths = self.paths()
+        number = (int(os.path.basename(paths[-1])[10:-4]) + 1
+                  if paths else 0)
+        path = os.path.join(self.directory,
+                            'telemetry-%010d.bin' % number)
+        self.current = Segment(path, self.columns, self.segment_records)
+        self.current.openForWriting()
+        for old in (paths + [path])[:-self.segments]:
+            os.remove(old)
+
+    def append(self, row, stamp=None):
+        """Store a dictionary of column values."""
+        if stamp is None:
+            stamp = time.time()
+        with self.lock:
+            # segments stay sorted by time, e.g. when the clock is set
+            if (self.current is None or self.current.full() or
+                    stamp < self.current.last()):
+                self.rotate()
+            self.current.append(stamp, row)
+            if time.monotonic() - self.lastFlush >= self.flush_seconds:
+                self.current.flush()
+                self.lastFlush = time.monotonic()
+
+    def record(self, outputs, stamp=None):
+        """Store the parsed outputs of COMMANDS, by command."""
+        self.append(to_row(outputs), stamp)
+
+    def query(self, start=None, end=None, columns=None):
+        """Return the records with start <= time < end as one array.
+
+        Only time and columns are returned if columns is given. Columns a
+        segment does not have are NaN.
+        """
+        start = -np.inf if start is None else start
+        end = np.inf if end is None else end
+        for column in columns or []:
+            if column not in COLUMNS:
+                raise KeyError(column)
+        dtype = record_dtype(columns or self.columns)
+        parts = []
+        with self.lock:
+            for path in self.paths():
+                if (self.current is not None and
+                        path == self.current.path):
+                    segment = self.current
+                else:
+                    segment = Segment(path)
+                view = segment.range(start, end)
+                part = np.zeros(len(view), dtype=dtype)
+                for name in dtype.names:
+                    if name in view.dtype.names:
+                        part[name] = view[name]
+                    else:
+                        part[name] = np.nan
+                parts.append(part)
+        if not parts:
+            return np.zeros(0, dtype=dtype)
+        return np.concatenate(parts)
+
+    def downsample(self, interval, start=None, end=None, columns=None,
+                   how='mean'):
+        """Aggregate the records per interval seconds.
+
+        how is mean, min or max, missing values are ignored. Returns a
+        record per interval that has samples, with the start of the
+        interval as time.
+        """
+        records = self.query(start, end, columns)
+        columns = [c for c in records.dtype.names if c != 'time']
+        if len(records) == 0:
+            return records
+        records = records[np.argsort(records['time'], kind='stable')]
+        bucket = np.floor(records['time'] / interval)
+        first = np.concatenate(([0], np.flatnonzero(np.diff(bucket)) + 1))
+        result = np.zeros(len(first), dtype=records.dtype)
+        result['time'] = bucket[first] * interval
+        for column in columns:
+            values = records[column].astype(np.float64)
+            if how == 'mean':
+                valid = ~np.isnan(values)
+                sums = np.add.reduceat(np.where(valid, values, 0.0), first)
+                counts = np.add.reduceat(valid.astype(np.int64), first)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    result[column] = sums / counts
+            elif how == 'min':
+                result[column] = np.fmin.reduceat(values, first)
+            elif how == 'max':
+                result[column] = np.fmax.reduceat(values, first)
+            else:
+                raise ValueError("how must be mean, min or max: "+how)
+        return result
+
+    def flush(self):
+        """Write pending records to disk."""
+        with self.lock:
+            if self.current is not None:
+                self.current.flush()
+            self.lastFlush = time.monotonic()
+
+    def close(self):
+        """Flush and close the history."""
+        with self.lock:
+            if self.current is not None:
+                self.current.close()
+                self.current = None
+
+
+class HistorySampler:
+    """Sample COMMANDS into a history at a fixed interval.
+
+    Samples are taken on the SerialWorker at a priority below telemetry
+    polls, batched into one exchange.
+    """
+
+    def __init__(self, worker, history, interval):
+        """Initialize sampler, call start() to start sampling."""
+        self.log = logging.getLogger(__name__)
+        self.worker = worker
+        self.history = history
+        self.interval = float(interval)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self, neato):
+        """Take one sample, run on the worker."""
+        outputs = dict(zip(COMMANDS, neato.batch(COMMANDS)))
+        if any(output is not None for output in outputs.values()):
+            self.history.record(outputs)
+
+    def start(self):
+        """Start sampling in a thread of its own."""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling and flush the history."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.history.flush()
+
+    def run(self):
+        """Queue a sample every interval until stopped."""
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            future = self.worker.submit(self.sample, PRIORITY_HISTORY,
+                                        key='history')
+            try:
+                future.result()
+            except Exception as ex:
+                self.log.error("Could not sample history: "+str(ex))
+            self.stopped.wait(max(0.0, self.interval
+                                  - (time.monotonic() - started)))
+
+
+def open_history(config):
+    """Return the TelemetryHistory configured in the serial settings."""
+    if not config.get('history_dir'):
+        return None
+    return TelemetryHistory(config['history_dir'],
+                            config.get('history_segment_records', 65536),
+                            config.get('history_segments', 16),
+                            config.get('history_flush_seconds', 30))
+
+
+def parse_time(text):
+    """Parse an ISO date and time, or seconds since the epoch."""
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.datetime.fromisoformat(text).timestamp()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory')
+    parser.add_argument('--since', type=parse_time, default=None,
+                        help='ISO time or seconds since the epoch')
+    parser.add_argument('--until', type=parse_time, default=None)
+    parser.add_argument('--columns', default=None,
+                        help='comma separated, all by default: '
+                             + ', '.join(COLUMNS))
+    parser.add_argument('--every', type=float, default=None,
+                        help='aggregate per this many seconds')
+    parser.add_argument('--how', default='mean',
+                        choices=['mean', 'min', 'max'])
+    args = parser.parse_args()
+
+    history = TelemetryHistory(args.directory)
+    columns = args.columns.split(',') if args.columns else None
+    if args.every:
+        records = history.downsample(args.every, args.since, args.until,
+                                     columns, args.how)
+    else:
+        records = history.query(args.since, args.until, columns)
+    names = records.dtype.names
+    print(','.join(names))
+    for record in records:
+        print(','.join([datetime.datetime.fromtimestamp(
+            record['time']).isoformat(timespec='seconds')]
+            + ['' if np.isnan(record[name]) else '%g' % record[name]
+               for name in names[1:]]))
+    history.close()
@@ -0,0 +1,233 @@
+"""Lidar (LDS) scans as NumPy arrays and continuous scanning."""
+import collections
+import re
+import threading
+import numpy as np
+
+# the LDS reports one reading per degree
+READINGS_PER_SCAN = 360
+
+# first and longest wait in seconds before asking again when no scan came
+# back, e.g. while disconnected
+RETRY_INITIAL = 0.1
+RETRY_MAX = 5.0
+
+ROW_START = re.compile(rb'^\d', re.M)
+ROTATION_SPEED = re.compile(rb'^ROTATION_SPEED,([^,\r\n]*)', re.M)
+# error codes are hex, parse_rows reads their digits as decimal: this maps
+# the decimal number back to the hex one, e.g. 8035 to 0x8035
+HEX_OF_DECIMAL = sum(np.arange(10000) // 10 ** k % 10 * 16 ** k
+                     for k in range(4)).astype(np.uint16)
+
+
+def parse_rows(data):
+    """Return angle, distance, intensity and error of the rows in data.
+
+    All rows are converted at once, so this returns None if anything
+    between the first row and the end of data is not a well-formed row.
+    """
+    first = ROW_START.search(data)
+    if first is None:
+        return None
+    block = data[first.start():].replace(b'\r', b'')
+    rows = block.count(b'\n') + (not block.endswith(b'\n'))
+    text = block.replace(b'\n', b',').rstrip(b',')
+    if text.translate(None, b'0123456789,') or b',,' in text:
+        return None
+    values = np.fromstring(text, dtype=np.int64, sep=',')
+    if len(values) != rows * 4:
+        return None
+    values = values.reshape(rows, 4)[:READINGS_PER_SCAN]
+    if (values[:, 0].max() > 0x7fff or values[:, 1:3].max() > 0xffff or
+            values[:, 3].max() >= len(HEX_OF_DECIMAL)):
+        return None
+    return (values[:, 0].astype(np.int16), values[:, 1].astype(np.uint16),
+            values[:, 2].astype(np.uint16), HEX_OF_DECIMAL[values[:, 3]])
+
+
+def parse_rows_one_by_one(data):
+    """Return angle, distance, intensity and error of the rows in data.
+
+    Garbled rows and a row cut off at the end are skipped.
+    """
+    angle = np.empty(READINGS_PER_SCAN, dtype=np.int16)
+    distance = np.empty(READINGS_PER_SCAN, dtype=np.uint16)
+    intensity = np.empty(READINGS_PER_SCAN, dtype=np.uint16)
+    error = np.empty(READINGS_PER_SCAN, dtype=np.uint16)
+    n = 0
+    for line in data.splitlines():
+        if line[:1].isdigit() and n < READINGS_PER_SCAN:
+            try:
+                a, d, i, e = line.split(b',')[:4]
+                angle[n] = int(a)
+                distance[n] = int(d)
+                intensity[n] = int(i)
+                error[n] = int(e, 16)
+            except (ValueError, OverflowError):
+                continue
+            n += 1
+    return angle[:n], distance[:n], intensity[:n], error[:n]
+
+
+class LDSScan:
+    """A single lidar scan.
+
+    Holds one entry per reading in the arrays angle (degrees), distance
+    (mm), intensity and error (the error code Neato reports, 0 if the
+    reading is valid).
+    """
+
+    __slots__ = ('angle', 'distance', 'intensity', 'error', 'rotation_speed')
+
+    def __init__(self, angle, distance, intensity, error, rotation_speed=0.0):
+        """Initialize scan from arrays of equal length."""
+        self.angle = angle
+        self.distance = distance
+        self.intensity = intensity
+        self.error = error
+        self.rotation_speed = rotation_speed
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Parse the raw bytes of a GetLDSScan response.
+
+        Rows are AngleInDegrees,DistInMM,Intensity,ErrorCodeHEX followed by
+        a ROTATION_SPEED line. Everything else (the echoed command and the
+        header) is skipped, like garbled rows and a row cut off at the end.
+        """
+        data = bytes(buffer)
+        speed = ROTATION_SPEED.search(data)
+        rows = data if speed is None else data[:speed.start()]
+        columns = parse_rows(rows)
+        if columns is None:
+            # garbled, convert what can be converted row by row
+            columns = parse_rows_one_by_one(rows)
+        rotation_speed = 0.0
+        if speed is not None:
+            try:
+                rotation_speed = float(speed.group(1))
+            except ValueError:
+                pass
+        return cls(*columns, rotation_speed)
+
+    def __len__(self):
+        """Return the number of readings."""
+        return len(self.angle)
+
+    def __repr__(self):
+        """Return a short description of the scan."""
+        return ('LDSScan(readings=' + str(len(self)) + ', valid='
+                + str(int(self.valid().sum())) + ', rotation_speed='
+                + str(self.rotation_speed) + ')')
+
+    def valid(self):
+        """Return a mask of the readings without error and with a distance."""
+        return (self.error == 0) & (self.distance > 0)
+
+    def to_cartesian(self, valid_only=True):
+        """Return x and y (mm) of the readings relative to the robot.
+
+        The x axis points forward and angles increase counterclockwise, as
+        reported by the LDS. Invalid readings are dropped unless valid_only
+        is False, in which case they are NaN.
+        """
+        theta = np.deg2rad(self.angle.astype(np.float64))
+        distance = self.distance.astype(np.float64)
+        if valid_only:
+            mask = self.valid()
+            theta = theta[mask]
+            distance = distance[mask]
+        else:
+            distance[~self.valid()] = np.nan
+        return distance * np.cos(theta), distance * np.sin(theta)
+
+    def sector_min(self, sectors=8):
+        """Return the minimum valid distance (mm) for each sector.
+
+        The circle is split into equal sectors, the first one starting at 0
+        degrees. Sectors without a valid reading are infinite.
+        """
+        sector = (self.angle.astype(np.int64) % 360) * sectors // 360
+        distance = np.where(self.valid(), self.distance, np.inf)
+        result = np.full(sectors, np.inf)
+        np.minimum.at(result, sector, distance)
+        return result
+
+
+class LDSStream:
+    """Continuously fetch scans into a ring buffer of the latest scans.
+
+    Fetches scans back to back in a background thread. When
+    the buffer is full the oldest scan is dropped, so memory use is bounded
+    no matter how slowly scans are consumed:
+
+        stream = LDSStream(ns, size=10)
+        stream.start()
+        scan = stream.wait()
+        ...
+        stream.stop()
+    """
+
+    def __init__(self, neato, size=10):
+        """Initialize stream reading from a NeatoSerial instance."""
+        self.neato = neato
+        self.scans = collections.deque(maxlen=size)
+        self.dropped = 0
+        self.received = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Start fetching scans."""
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """Stop fetching scans and wait until the lidar is spun down.
+
+        That takes until the next scan comes back, up to RETRY_MAX seconds
+        while none do.
+        """
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def run(self):
+        """Fetch scans until stopped, see NeatoSerial.streamLDS."""
+        scans = self.neato.streamLDS(running=lambda: self.running)
+        try:
+            for scan in scans:
+                with self.condition:
+                    if len(self.scans) == self.scans.maxlen:
+                        self.dropped += 1
+                    self.scans.append(scan)
+                    self.received += 1
+                    self.condition.notify_all()
+        finally:
+            # spins the lidar down
+            scans.close()
+
+    def latest(self):
+        """Return the most recent scan, or None if there is none yet."""
+        with self.condition:
+            return self.scans[-1] if self.scans else None
+
+    def wait(self, timeout=None):
+        """Wait for the next scan and take it from the buffer.
+
+        Returns the oldest scan in the buffer, or None on timeout.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.scans, timeout):
+                return None
+            return self.scans.popleft()
+
+    def drain(self):
+        """Take all buffered scans, oldest first."""
+        with self.condition:
+            scans = list(self.scans)
+            self.scans.clear()
+            return scans
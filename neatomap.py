@@ -0,0 +1,294 @@
+"""Occupancy grid map from lidar scans and wheel odometry.
+
+The pose of the robot is dead reckoned from the wheel position counters of
+GetMotors and every scan is cast into a fixed-size grid of log-odds from
+that pose: cells a beam passed through become more likely free, the cell
+it ended in more likely occupied. Map while Neato drives around with:
+
+    python3 neatomap.py --scans 300 --png map.png --npz map.npz
+"""
+import argparse
+import math
+import struct
+import time
+import zlib
+import numpy as np
+
+# distance between the wheels of an XV in mm
+WHEEL_BASE_MM = 250
+
+# log-odds added for a beam ending in a cell and for passing through it
+LOG_ODDS_HIT = math.log(0.7 / 0.3)
+LOG_ODDS_MISS = math.log(0.4 / 0.6)
+# bounds of the log-odds, so cells can still change their mind
+LOG_ODDS_MIN = -6.0
+LOG_ODDS_MAX = 6.0
+
+
+class Odometry:
+    """Pose of the robot dead reckoned from its wheel positions.
+
+    x and y are in mm from where the robot was when odometry started, with
+    the x axis pointing forward from there. heading is in radians and
+    increases counterclockwise, like the angles of the LDS.
+    """
+
+    def __init__(self, wheel_base=WHEEL_BASE_MM):
+        """Initialize odometry at the origin."""
+        self.wheel_base = float(wheel_base)
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        self.left = None
+        self.right = None
+
+    @property
+    def pose(self):
+        """Return x, y and heading."""
+        return self.x, self.y, self.heading
+
+    def update(self, left, right):
+        """Move by the change of the wheel positions (mm) and return the pose.
+
+        The first positions only set where counting starts.
+        """
+        if self.left is not None:
+            dl = left - self.left
+            dr = right - self.right
+            distance = (dl + dr) / 2
+            turn = (dr - dl) / self.wheel_base
+            # drive along the mean heading of the arc
+            heading = self.heading + turn / 2
+            self.x += distance * math.cos(heading)
+            self.y += distance * math.sin(heading)
+            self.heading = (self.heading + turn) % (2 * math.pi)
+        self.left = left
+        self.right = right
+        return self.pose
+
+    def update_motors(self, motors):
+        """Update from the parsed output of GetMotors and return the pose."""
+        return self.update(float(motors['LeftWheel_PositionInMM']),
+                           float(motors['RightWheel_PositionInMM']))
+
+
+class OccupancyGrid:
+    """Square grid of log-odds that cells are occupied.
+
+    The grid is allocated once, size mm wide with cells of resolution mm,
+    and centered on the origin of the odometry. Everything outside it is
+    ignored. Readings farther than max_range only clear the cells up to
+    max_range.
+    """
+
+    def __init__(self, size=20000, resolution=50, max_range=5000):
+        """Initialize grid with all cells unknown."""
+        self.resolution = float(resolution)
+        self.max_range = float(max_range)
+        self.cells = int(math.ceil(size / self.resolution))
+        # world coordinates (mm) of the lower left corner of cell 0, 0
+        self.origin = -self.cells * self.resolution / 2
+        self.logodds = np.zeros((self.cells, self.cells), dtype=np.float32)
+        self.scans = 0
+
+    def cell_indices(self, x, y):
+        """Return flat indices of the cells of points x, y (mm) in the grid.
+
+        Points outside the grid are dropped.
+        """
+        col = np.floor((x - self.origin) / self.resolution).astype(np.int64)
+        row = np.floor((y - self.origin) / self.resolution).astype(np.int64)
+        inside = ((col >= 0) & (col < self.cells) &
+                  (row >= 0) & (row < self.cells))
+        return row[inside] * self.cells + col[inside]
+
+    def integrate(self, scan, pose):
+        """Cast the valid readings of an LDSScan from pose into the grid.
+
+        Every beam is sampled every half cell up to its reading, all beams
+        at once: the cells sampled are updated as free once per scan, the
+        cells the readings end in as occupied.
+        """
+        x, y, heading = pose
+        mask = scan.valid()
+        distance = scan.distance[mask].astype(np.float64)
+        theta = np.deg2rad(scan.angle[mask].astype(np.float64)) + heading
+        dx = np.cos(theta)
+        dy = np.sin(theta)
+        hit = distance <= self.max_range
+        distance = np.minimum(distance, self.max_range)
+
+        # samples of all beams back to back: beam i has n[i] samples at
+        # 0, step, 2 * step, ... short of its reading
+        step = self.resolution / 2
+        n = np.ceil(distance / step).astype(np.int64)
+        beam = np.repeat(np.arange(len(n)), n)
+        first = np.repeat(np.cumsum(n) - n, n)
+        t = (np.arange(len(beam)) - first) * step
+        free = np.unique(self.cell_indices(x + t * dx[beam],
+                                           y + t * dy[beam]))
+        occupied = np.unique(self.cell_indices(
+            x + distance[hit] * dx[hit], y + distance[hit] * dy[hit]))
+        free = np.setdiff1d(free, occupied, assume_unique=True)
+
+        flat = self.logodds.reshape(-1)
+        flat[free] = np.maximum(flat[free] + LOG_ODDS_MISS, LOG_ODDS_MIN)
+        flat[occupied] = np.minimum(flat[occupied] + LOG_ODDS_HIT,
+                                    LOG_ODDS_MAX)
+        self.scans += 1
+
+    def probabilities(self):
+        """Return the probability every cell is occupied, 0.5 if unknown.
+
+        Rows go up along the y axis, columns along the x axis.
+        """
+        return 1 - 1 / (1 + np.exp(self.logodds))
+
+    def to_image(self):
+        """Return the map as 8-bit gray levels with north up.
+
+        Occupied cells are black, free cells white and unknown ones gray.
+        """
+        gray = np.rint((1 - self.probabilities()) * 255).astype(np.uint8)
+        # image rows go down, the y axis goes up
+        return gray[::-1]
+
+    def save_png(self, path):
+        """Write the map as a grayscale PNG."""
+        image = self.to_image()
+        height, width = image.shape
+        # every row starts with filter type 0 (none)
+        raw = np.zeros((height, width + 1), dtype=np.uint8)
+        raw[:, 1:] = image
+
+        def chunk(kind, data):
+            return (struct.pack('>I', len(data)) + kind + data +
+                    struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+        with open(path, 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n')
+            f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                               8, 0, 0, 0, 0)))
+            f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+            f.write(chunk(b'IEND', b''))
+
+    def save(self, path):
+        """Write the log-odds and the geometry of the grid to an .npz."""
+        np.savez_compressed(path, logodds=self.logodds,
+                            resolution=self.resolution,
+                            max_range=self.max_range, origin=self.origin,
+                            scans=self.scans)
+
+    @classmethod
+    def load(cls, path):
+        """Return the grid saved in path, to continue mapping."""
+        with np.load(path) as data:
+            grid = cls(resolution=float(data['resolution']),
+                       max_range=float(data['max_range']),
+                       size=data['logodds'].shape[0] *
+                       float(data['resolution']))
+            grid.logodds[...] = data['logodds']
+            grid.origin = float(data['origin'])
+            grid.scans = int(data['scans'])
+        return grid
+
+
+class Mapper:
+    """Build an occupancy grid from scans and wheel positions as they come.
+
+        mapper = Mapper(OccupancyGrid())
+        for scan in ns.streamLDS(100):
+            mapper.update(scan, ns.getMotors())
+        mapper.grid.save_png('map.png')
+    """
+
+    def __init__(self, grid, odometry=None, max_turn=20):
+        """Initialize mapper adding to grid.
+
+        Scans during which the robot turned more than max_turn degrees are
+        smeared too much to be of use and are skipped.
+        """
+        self.grid = grid
+        self.odometry = Odometry() if odometry is None else odometry
+        self.max_turn = math.radians(max_turn)
+        self.skipped = 0
+        self.seconds = 0.0
+
+    def update(self, scan, motors):
+        """Move to the pose from GetMotors and add the scan from there.
+
+        motors should be read right after the scan. Returns the pose, or
+        None when motors is missing or the scan was skipped.
+        """
+        if not motors:
+            return None
+        heading = self.odometry.heading
+        pose = self.odometry.update_motors(motors)
+        turn = abs((pose[2] - heading + math.pi) % (2 * math.pi) - math.pi)
+        if turn > self.max_turn:
+            self.skipped += 1
+            return None
+        start = time.perf_counter()
+        self.grid.integrate(scan, pose)
+        self.seconds += time.perf_counter() - start
+        return pose
+
+    def run(self, neato, count=None):
+        """Stream scans from a NeatoSerial and add them, count or forever.
+
+        Yields the pose after every scan added.
+        """
+        for scan in neato.streamLDS(count):
+            pose = self.update(scan, neato.getMotors())
+            if pose is not None:
+                yield pose
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scans', type=int, default=100,
+                        help='number of scans to add')
+    parser.add_argument('--size', type=float, default=20000,
+                        help='width of the map in mm')
+    parser.add_argument('--resolution', type=float, default=50,
+                        help='width of a cell in mm')
+    parser.add_argument('--max-range', type=float, default=5000,
+                        help='ignore readings beyond this many mm')
+    parser.add_argument('--wheel-base', type=float, default=WHEEL_BASE_MM,
+                        help='distance between the wheels in mm')
+    parser.add_argument('--max-turn', type=float, default=20,
+                        help='skip scans while turning more than this many '
+                        'degrees')
+    parser.add_argument('--load', default=None,
+                        help='continue the map in this .npz')
+    parser.add_argument('--png', default='map.png',
+                        help='write the map to this PNG')
+    parser.add_argument('--npz', default=None,
+                        help='also write the map to this .npz')
+    parser.add_argument('--every', type=int, default=0,
+                        help='also write the PNG after every this many scans')
+    args = parser.parse_args()
+
+    from neatoserial import NeatoSerial
+    if args.load:
+        grid = OccupancyGrid.load(args.load)
+    else:
+        grid = OccupancyGrid(args.size, args.resolution, args.max_range)
+    mapper = Mapper(grid, Odometry(args.wheel_base), args.max_turn)
+    ns = NeatoSerial()
+    n = 0
+    try:
+        for x, y, heading in mapper.run(ns, args.scans):
+            n += 1
+            print('%4d x %7.0f y %7.0f heading %5.1f' % (
+                n, x, y, math.degrees(heading)))
+            if args.every and n % args.every == 0:
+                grid.save_png(args.png)
+    finally:
+        grid.save_png(args.png)
+        if args.npz:
+            grid.save(args.npz)
+        ns.close()
+    if n:
+        print('%d scans, %d skipped, %.1f ms per scan' % (
+            n, mapper.skipped, mapper.seconds / n * 1000))
@@ -0,0 +1,226 @@
+"""Instrumentation of the serial connection, exported as Prometheus metrics."""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# name -> (type, help)
+METRICS = {
+    'neato_command_seconds': (
+        'histogram', 'Time from writing a command to its complete response.'),
+    'neato_write_seconds': (
+        'histogram', 'Time of a write including wake-ups and retries.'),
+    'neato_commands_total': ('counter', 'Commands written to Neato.'),
+    'neato_bytes_sent_total': ('counter', 'Bytes written to Neato.'),
+    'neato_bytes_received_total': ('counter', 'Bytes received from Neato.'),
+    'neato_empty_responses_total': (
+        'counter', 'Commands Neato did not answer.'),
+    'neato_stale_responses_total': (
+        'counter', 'Late responses to earlier commands thrown away.'),
+    'neato_wakeups_total': ('counter', 'Wake-up messages sent.'),
+    'neato_reconnects_total': ('counter', 'Reconnects to Neato.'),
+    'neato_usb_toggles_total': ('counter', 'USB connection toggles.'),
+    'neato_errors_total': ('counter', 'Exceptions talking to Neato.'),
+    'neato_clean_workflows_total': (
+        'counter', 'Finished Clean workflows by result.'),
+    'neato_mqtt_messages_total': ('counter', 'MQTT messages published.'),
+    'neato_mqtt_batches_total': (
+        'counter', 'Batches MQTT messages were published in.'),
+    'neato_sleep_seconds_total': (
+        'counter', 'Time spent in fixed sleeps.'),
+}
+
+
+class Histogram:
+    """Cumulative histogram of observed values."""
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        """Initialize empty histogram."""
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add a value."""
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Thread-safe registry of counters and histograms with labels."""
+
+    def __init__(self):
+        """Initialize empty registry."""
+        self.lock = threading.Lock()
+        # (name, sorted label items) -> value or Histogram
+        self.values = {}
+
+    def inc(self, name, value=1, **labels):
+        """Increase a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Add a value to a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the time spent in the context in a histogram."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def sleep(self, seconds, where):
+        """Sleep and count the time slept."""
+        time.sleep(seconds)
+        self.inc('neato_sleep_seconds_total', seconds, where=where)
+
+    def labeled(self, **labels):
+        """Return a view adding labels to everything counted through it."""
+        return Labeled(self, labels)
+
+    def snapshot(self):
+        """Return the counters and histogram counts and sums as a dict."""
+        result = {}
+        with self.lock:
+            for (name, labels), value in sorted(self.values.items()):
+                key = name + format_labels(labels)
+                if isinstance(value, Histogram):
+                    result[key] = {'count': value.count, 'sum': value.sum}
+                else:
+                    result[key] = value
+        return result
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        lines = []
+        with self.lock:
+            items = sorted(self.values.items())
+            described = set()
+            for (name, labels), value in items:
+                if name not in described:
+                    kind, text = METRICS.get(name, ('untyped', name))
+                    lines.append('# HELP ' + name + ' ' + text)
+                    lines.append('# TYPE ' + name + ' ' + kind)
+                    described.add(name)
+                if isinstance(value, Histogram):
+                    for bound, count in zip(BUCKETS, value.counts):
+                        lines.append(name + '_bucket' + format_labels(
+                            labels + (('le', str(bound)),)) + ' '
+                            + str(count))
+                    lines.append(name + '_bucket' + format_labels(
+                        labels + (('le', '+Inf'),)) + ' ' + str(value.count))
+                    lines.append(name + '_sum' + format_labels(labels) + ' '
+                                 + repr(value.sum))
+                    lines.append(name + '_count' + format_labels(labels)
+                                 + ' ' + str(value.count))
+                else:
+                    lines.append(name + format_labels(labels) + ' '
+                                 + repr(value))
+        return '\n'.join(lines) + '\n'
+
+    def write_file(self, path):
+        """Write all metrics to a file, replacing it atomically.
+
+        Suits e.g. the textfile collector of node_exporter.
+        """
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, port, host=''):
+        """Serve the metrics over HTTP in a background thread."""
+        # imported here, it slows down startup when not used
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def start(self, config):
+        """Start the exporters configured in the metrics section."""
+        if config.get('prometheus_port'):
+            self.serve(int(config['prometheus_port']))
+        if config.get('prometheus_file'):
+            interval = float(config.get('file_interval_seconds', 15))
+
+            def write_periodically():
+                while True:
+                    self.write_file(config['prometheus_file'])
+                    time.sleep(interval)
+            threading.Thread(target=write_periodically, daemon=True).start()
+
+
+class Labeled:
+    """Metrics of a registry with labels of their own, e.g. of one robot.
+
+        robot = metrics.labeled(robot='downstairs')
+        robot.inc('neato_wakeups_total')
+    """
+
+    def __init__(self, registry, labels):
+        """Initialize view adding labels to the values of registry."""
+        self.registry = registry
+        self.labels = labels
+
+    def inc(self, name, value=1, **labels):
+        """Increase a counter."""
+        self.registry.inc(name, value, **dict(self.labels, **labels))
+
+    def observe(self, name, value, **labels):
+        """Add a value to a histogram."""
+        self.registry.observe(name, value, **dict(self.labels, **labels))
+
+    def timer(self, name, **labels):
+        """Observe the time spent in the context in a histogram."""
+        return self.registry.timer(name, **dict(self.labels, **labels))
+
+    def sleep(self, seconds, where):
+        """Sleep and count the time slept."""
+        time.sleep(seconds)
+        self.inc('neato_sleep_seconds_total', seconds, where=where)
+
+
+def format_labels(labels):
+    """Format label items as {name="value",...}."""
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"') + '"'
+        for k, v in labels) + '}'
+
+
+# the registry all NeatoSerial instances report to
+metrics = Metrics()
@@ -0,0 +1,122 @@
+"""Typed parsers for the responses of Neato commands."""
+from collections import namedtuple
+
+Measurement = namedtuple('Measurement', ['value', 'unit'])
+VersionInfo = namedtuple('VersionInfo', ['major', 'minor', 'build'])
+ErrorInfo = namedtuple('ErrorInfo', ['code', 'message'])
+
+# command name -> parser function, see parser()
+PARSERS = {}
+
+
+def parser(*commands, raw=False):
+    """Register the decorated function as parser for the given commands.
+
+    The parser is called with the decoded output, or with the raw bytes if
+    raw is True.
+    """
+    def register(func):
+        func.raw = raw
+        for command in commands:
+            PARSERS[command] = func
+        return func
+    return register
+
+
+def parse(command, output):
+    """Parse output of command with its registered parser.
+
+    Returns None if there is no output and raises KeyError if no parser is
+    registered for the command.
+    """
+    func = PARSERS[command.split(' ')[0]]
+    if output is None:
+        return None
+    if func.raw:
+        if isinstance(output, str):
+            output = output.encode('utf-8')
+    elif not isinstance(output, str):
+        output = str(output, 'utf-8')
+    return func(output)
+
+
+def to_value(text):
+    """Convert a field to an int or float if it is numeric."""
+    text = text.strip()
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+@parser('GetAccel', 'GetButtons', 'GetCalInfo', 'GetCharger',
+        'GetDigitalSensors', 'GetMotors')
+def parse_key_value(output):
+    """Parse a Label,Value table into a dictionary of typed values.
+
+    The first row is the header, like Label,Value or Parameter,Value, and
+    is skipped.
+    """
+    result = {}
+    header = True
+    for line in output.splitlines():
+        label, sep, rest = line.partition(',')
+        if sep:
+            if header:
+                header = False
+                continue
+            result[label] = to_value(rest.split(',', 1)[0])
+    return result
+
+
+@parser('GetAnalogSensors')
+def parse_analog_sensors(output):
+    """Parse analog sensors into a dictionary of measurements.
+
+    Firmware 3.x reports SensorName,Unit,Value while older firmware
+    reports SensorName,Value without a unit.
+    """
+    result = {}
+    for line in output.splitlines():
+        fields = line.split(',')
+        if len(fields) > 2 and fields[2] != '':
+            result[fields[0]] = Measurement(to_value(fields[2]), fields[1])
+        elif len(fields) > 1:
+            result[fields[0]] = Measurement(to_value(fields[1]), '')
+    return result
+
+
+@parser('GetVersion')
+def parse_version(output):
+    """Parse Component,Major,Minor,Build into a dictionary of versions."""
+    result = {}
+    for line in output.splitlines():
+        fields = line.split(',')
+        if len(fields) > 1:
+            fields += [''] * (4 - len(fields))
+            result[fields[0]] = VersionInfo(to_value(fields[1]),
+                                            to_value(fields[2]),
+                                            to_value(fields[3]))
+    return result
+
+
+@parser('GetLDSScan', raw=True)
+def parse_lds_scan(output):
+    """Parse a lidar scan into NumPy arrays, see neatolds.LDSScan."""
+    # imported here so NumPy is only loaded when scans are used
+    from neatolds import LDSScan
+    return LDSScan.from_buffer(output)
+
+
+@parser('GetErr')
+def parse_error(output):
+    """Parse an error line like '220 - Unplug USB...' if there is one."""
+    for line in output.splitlines():
+        code, sep, message = line.partition(' - ')
+        if sep and code.strip().isdigit():
+            return ErrorInfo(int(code), message)
+    return None
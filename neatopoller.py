@@ -0,0 +1,112 @@
+"""State-adaptive polling schedule for Neato telemetry."""
+import threading
+import time
+
+# seconds between polls of each metric per robot state, None polls once
+DEFAULT_INTERVALS = {
+    'docked': {'charger': 60, 'motors': 60, 'error': 60, 'version': None},
+    'idle': {'charger': 30, 'motors': 15, 'error': 15, 'version': None},
+    'cleaning': {'charger': 15, 'motors': 5, 'error': 2, 'version': None},
+}
+
+# the query command each metric is read from
+METRIC_COMMANDS = {
+    'charger': 'GetCharger',
+    'motors': 'GetMotors',
+    'error': 'GetErr',
+    'version': 'GetVersion',
+}
+
+
+class AdaptivePoller:
+    """Decide which metrics are due, based on the state of the robot.
+
+    Every metric has its own interval per robot state (docked, idle or
+    cleaning). trigger() makes every metric due right away, e.g. after a
+    command was sent:
+
+        poller = AdaptivePoller()
+        while True:
+            metrics = poller.due('docked')
+            ...poll metrics...
+            poller.polled(metrics, 'docked')
+            poller.wait('docked')
+    """
+
+    def __init__(self, intervals=None):
+        """Initialize poller, intervals override DEFAULT_INTERVALS."""
+        self.intervals = {state: dict(metrics)
+                          for state, metrics in DEFAULT_INTERVALS.items()}
+        for state, metrics in (intervals or {}).items():
+            self.intervals.setdefault(state, {}).update(metrics)
+        # metric -> monotonic time it is due, None once polled for good
+        self.nextPoll = {metric: 0.0 for metric in METRIC_COMMANDS}
+        self.triggered = threading.Event()
+        self.lock = threading.Lock()
+        # bumped by trigger(), and as it was when due() was last called
+        self.generation = 0
+        self.cycleGeneration = 0
+
+    def interval(self, metric, state):
+        """Return the interval of metric in state."""
+        return self.intervals.get(state, self.intervals['idle']).get(
+            metric, self.intervals['idle'].get(metric))
+
+    def due(self, state, now=None):
+        """Return the metrics due for polling."""
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            self.cycleGeneration = self.generation
+            return [metric for metric, at in self.nextPoll.items()
+                    if at is not None and at <= now]
+
+    def polled(self, metrics, state, now=None):
+        """Schedule the next poll of metrics polled in state.
+
+        Metrics trigger() made due again since due() stay due, what they
+        were polled for may have changed in the meantime.
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            triggered = self.generation != self.cycleGeneration
+            for metric in metrics:
+                interval = self.interval(metric, state)
+                if interval is None:
+                    self.nextPoll[metric] = None
+                elif not triggered:
+                    self.nextPoll[metric] = now + interval
+
+    def reschedule(self, state, now=None):
+        """Shorten waits that are longer than the interval of a new state."""
+        if now is None:
+            now = time.monotonic()
+        for metric, at in self.nextPoll.items():
+            interval = self.interval(metric, state)
+            if (at is not None and interval is not None and
+                    at > now + interval):
+                self.nextPoll[metric] = now + interval
+
+    def trigger(self):
+        """Make every repeating metric due now and wake up wait()."""
+        with self.lock:
+            for metric, at in self.nextPoll.items():
+                if at is not None:
+                    self.nextPoll[metric] = 0.0
+            self.generation += 1
+        self.triggered.set()
+
+    def reset(self, metric):
+        """Poll a metric again, even one that is only polled once."""
+        self.nextPoll[metric] = 0.0
+
+    def wait(self, state):
+        """Sleep until a metric is due or trigger() is called."""
+        pending = [at for at in self.nextPoll.values() if at is not None]
+        if not pending:
+            timeout = None
+        else:
+            timeout = max(0.0, min(pending) - time.monotonic())
+        self.triggered.wait(timeout)
+        self.triggered.clear()
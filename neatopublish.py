@@ -0,0 +1,103 @@
+"""Outbound MQTT publish queue, drained by the network loop."""
+import logging
+import queue
+import threading
+import time
+import paho.mqtt.client as mqtt
+from neatometrics import metrics
+
+
+class PublishQueue:
+    """Queue MQTT messages from any thread, send them from the network loop.
+
+    publish() only queues the message, so it can be called from paho
+    callbacks, serial workers and timers alike. run() drives the network
+    loop of the client and after every pass sends everything queued since
+    in one batch. QoS and retain come from the first topic filter in
+    policies that matches the topic, unless given:
+
+        publisher = PublishQueue(client, {'hass/#': (1, True)})
+        client.connect(host, port)
+        publisher.start()
+        publisher.publish('vacuum/state', payload)
+    """
+
+    def __init__(self, client, policies=None, interval=0.1,
+                 reconnect_max=60):
+        """Initialize queue, policies map topic filters to (qos, retain)."""
+        self.log = logging.getLogger(__name__)
+        self.client = client
+        self.policies = dict(policies or {})
+        self.interval = interval
+        self.reconnect_max = reconnect_max
+        self.queue = queue.Queue()
+        self.running = False
+        self.thread = None
+
+    def setPolicy(self, pattern, qos, retain):
+        """Set QoS and retain of the topics matching a topic filter."""
+        self.policies[pattern] = (qos, retain)
+
+    def policy(self, topic):
+        """Return QoS and retain of topic."""
+        # copied, policies may be set from other threads
+        for pattern, policy in list(self.policies.items()):
+            if mqtt.topic_matches_sub(pattern, topic):
+                return policy
+        return 0, False
+
+    def publish(self, topic, payload, qos=None, retain=None):
+        """Queue a message, to be sent by the network loop."""
+        default_qos, default_retain = self.policy(topic)
+        self.queue.put((topic, payload,
+                        default_qos if qos is None else qos,
+                        default_retain if retain is None else retain))
+
+    def drain(self):
+        """Send all queued messages and return how many were sent."""
+        sent = 0
+        while True:
+            try:
+                topic, payload, qos, retain = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.client.publish(topic, payload, qos=qos, retain=retain)
+            sent += 1
+        if sent:
+            metrics.inc('neato_mqtt_messages_total', sent)
+            metrics.inc('neato_mqtt_batches_total')
+        return sent
+
+    def start(self):
+        """Start the network loop in a thread of its own."""
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Send what is still queued and stop the network loop."""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        """Run the network loop, reconnecting with backoff when it fails."""
+        delay = 1
+        while self.running:
+            rc = self.client.loop(self.interval)
+            if rc == mqtt.MQTT_ERR_SUCCESS:
+                # messages queued while disconnected wait for the broker
+                self.drain()
+                delay = 1
+                continue
+            self.log.info("MQTT network loop failed ("+str(rc)
+                          + "), reconnecting in "+str(delay)+" seconds")
+            time.sleep(delay)
+            delay = min(delay * 2, self.reconnect_max)
+            try:
+                self.client.reconnect()
+            except OSError as ex:
+                self.log.error("Could not reconnect to broker: "+str(ex))
+        self.drain()
+        self.client.loop(self.interval)
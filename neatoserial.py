@@ -2,20 +2,79 @@
 from config import settings
 import serial
 import os
+import random
 import time
-import RPi.GPIO as GPIO
 import logging
+from neatoparsers import PARSERS, parse
+from neatometrics import metrics
+from neatotrace import open_trace, TX, RX, EVENT
+from neatotransport import open_transport
+from contextlib import contextmanager
+
+# the XV firmware ends every response with a Ctrl-Z
+RESPONSE_TERMINATOR = b'\x1a'
+
+
+def echo_of(response):
+    """Return the command echoed on the first line of a response, lowered."""
+    echo = bytes(response).lstrip().split(b'\r\n', 1)[0]
+    return echo.strip().decode('utf-8', 'replace').lower()
+
+
+def robot_name(config):
+    """Return the name of the robot configured in the serial settings."""
+    return str(config.get('name') or config.get('usb_serial_number') or
+               config.get('serial_device') or 'neato')
 
 
 class NeatoSerial:
     """Serial interface to Neato."""
 
-    def __init__(self):
-        """Initialize serial connection to Neato."""
+    def __init__(self, config=None, transport=None):
+        """Initialize serial connection to Neato.
+
+        config defaults to the serial section of the settings, transport to
+        the one configured there (see neatotransport).
+        """
         self.log = logging.getLogger(__name__)
-        if settings['serial']['usb_switch_mode'] == 'relay':
-            # use relay to temporarily disconnect neato to trigger clean
-            self.pin = int(settings['serial']['relay_gpio'])
+        self.config = settings['serial'] if config is None else config
+        # labeled, to tell robots apart in gateway mode
+        self.metrics = metrics.labeled(robot=robot_name(self.config))
+        self.framing = self.config.get('response_framing', 'terminator')
+        self.command_timeout = float(
+            self.config.get('command_timeout_seconds', 2))
+        self.wakeup_idle = float(
+            self.config.get('wakeup_idle_seconds', 30))
+        self.lastActive = None
+        self.snapshot_ttl = float(
+            self.config.get('snapshot_ttl_seconds', 0))
+        self.snapshot = {}
+        self.pollDepth = 0
+        # reusable receive buffer, grown when a response does not fit
+        self.rxbuf = bytearray(
+            int(self.config.get('receive_buffer_bytes', 16384)))
+        self.rxview = memoryview(self.rxbuf)
+        self.rxlen = 0
+        self.reconnect_initial = float(
+            self.config.get('reconnect_initial_seconds', 0.05))
+        self.reconnect_max = float(
+            self.config.get('reconnect_max_seconds', 0.2))
+        self.reconnect_timeout = float(
+            self.config.get('reconnect_timeout_seconds', 60))
+        self.ser = None
+        # called on error 220 instead of toggling USB right away, e.g. to
+        # leave it to a neatoclean.CleanWorkflow
+        self.unplugUsbHandler = None
+        self.transport = (open_transport(self.config) if transport is None
+                          else transport)
+        # optional wire-level trace, see neatotrace
+        self.trace = open_trace(self.config)
+        if self.config['usb_switch_mode'] == 'relay':
+            # use relay to temporarily disconnect neato to trigger clean,
+            # only imported here since it is only available on a Pi
+            import RPi.GPIO as GPIO
+            self.GPIO = GPIO
+            self.pin = int(self.config['relay_gpio'])
             GPIO.setmode(GPIO.BCM)
             GPIO.setwarnings(False)
             GPIO.setup(self.pin, GPIO.OUT)
@@ -24,20 +83,22 @@ class NeatoSerial:
 
     def connect(self):
         """Connect to serial port."""
-        devices = settings['serial']['serial_device'].split(',')
-        for dev in devices:
+        # a fresh connection always needs a wake-up first and might be to
+        # another device
+        self.lastActive = None
+        self.version = None
+        for dev in self.transport.devices():
             try:
-                self.ser = serial.Serial(dev, 115200,
-                                         serial.EIGHTBITS, serial.PARITY_NONE,
-                                         serial.STOPBITS_ONE,
-                                         settings['serial']['timeout_seconds'])
+                self.ser = self.transport.open(dev)
                 self.open()
+                if self.trace is not None:
+                    self.trace.record(EVENT, 'connect', dev.encode('utf-8'))
                 self.log.debug("Connected to Neato at "+dev)
                 print("Connected to Neato at "+dev)
                 return True
-            except:
-                self.log.error("Could not connect to device "+dev+". "
-                               + "Trying next device.")
+            except (OSError, serial.SerialException) as ex:
+                self.log.error("Could not connect to device "+dev+": "
+                               + str(ex)+". Trying next device.")
                 print("Could not connect to device "+dev+". "
                       + "Trying next device.")
         return False
@@ -59,55 +120,151 @@ class NeatoSerial:
     def close(self):
         """Close serial port."""
         print("Entering CLOSE()")
-        self.ser.close()
+        if self.ser is not None:
+            self.ser.close()
         self.isConnected = False
         print("Leaving CLOSE, isConnected= "+str(self.isConnected))
 
+    def reserve(self, size):
+        """Make room for size more bytes in the receive buffer."""
+        needed = self.rxlen + size
+        if needed > len(self.rxbuf):
+            # replace rather than resize, callers may still hold a view
+            grown = bytearray(max(needed, 2 * len(self.rxbuf)))
+            grown[:self.rxlen] = self.rxview[:self.rxlen]
+            self.rxbuf = grown
+            self.rxview = memoryview(grown)
+
+    def received(self):
+        """Return a view on the bytes of the last response, without copying."""
+        return self.rxview[:self.rxlen]
+
     def read_all(self, port, chunk_size=200):
-        """Read all characters on the serial port and return them."""
+        """Read all characters on the serial port into the receive buffer.
+
+        Returns a view on everything received for the current response.
+        """
         if not port.timeout:
             raise TypeError('Port needs to have a timeout set!')
-        read_buffer = b''
         while True:
             # Read in chunks. Each chunk will wait as long as specified by
             # timeout. Increase chunk_size to fail quicker
-            byte_chunk = port.read(size=chunk_size)
-            read_buffer += byte_chunk
-            if not len(byte_chunk) == chunk_size:
+            self.reserve(chunk_size)
+            n = port.readinto(self.rxview[self.rxlen:self.rxlen + chunk_size])
+            self.rxlen += n or 0
+            if not n == chunk_size:
                 break
-        return read_buffer
+        return self.received()
+
+    def read_response(self, timeout=None, count=1, echo=None):
+        """Read count responses up to their terminator or until the deadline.
+
+        Returns a view on the responses in the receive buffer, without the
+        last terminator. With echo, responses before the first one echoing
+        it, like the late response to a command that timed out, are thrown
+        away.
+        """
+        if timeout is None:
+            timeout = self.command_timeout
+        deadline = time.monotonic() + timeout
+        self.rxlen = 0
+        found = 0
+        while time.monotonic() < deadline:
+            # read whatever is waiting, or block for at most the port timeout
+            # for the next byte to arrive
+            size = max(1, self.ser.inWaiting())
+            self.reserve(size)
+            n = self.ser.readinto(self.rxview[self.rxlen:self.rxlen + size])
+            if n:
+                end = self.rxbuf.find(RESPONSE_TERMINATOR,
+                                      self.rxlen, self.rxlen + n)
+                self.rxlen += n
+                while end >= 0:
+                    if (found == 0 and echo is not None and
+                            not self.echoes(end, echo)):
+                        self.metrics.inc('neato_stale_responses_total')
+                        self.log.debug("Dropped stale response to "
+                                       + repr(bytes(self.rxview[:40])))
+                        rest = self.rxlen - end - 1
+                        self.rxbuf[:rest] = bytes(
+                            self.rxview[end + 1:self.rxlen])
+                        self.rxlen = rest
+                        end = self.rxbuf.find(RESPONSE_TERMINATOR, 0,
+                                              self.rxlen)
+                        continue
+                    found += 1
+                    if found == count:
+                        self.rxlen = end
+                        return self.received()
+                    end = self.rxbuf.find(RESPONSE_TERMINATOR,
+                                          end + 1, self.rxlen)
+        self.log.debug("No response terminator received within "
+                       + str(timeout) + " seconds")
+        return self.received()
+
+    def echoes(self, end, msg):
+        """Return if the response in the buffer up to end echoes msg."""
+        # the echo is on the first line, no need to look further
+        return echo_of(self.rxview[:min(end, 256)]) == msg.strip().lower()
 
     def toggleusb(self):
         """Toggle USB connection to Neato."""
         print("Entering TOGGLEUSB()")
-        if settings['serial']['usb_switch_mode'] == 'direct':
+        self.switchUsb(False)
+        if self.config['usb_switch_mode'] in ('direct', 'relay'):
+            self.metrics.sleep(1, 'toggleusb')
+        self.switchUsb(True)
+        print("Leaving TOGGLEUSB()")
+
+    def switchUsb(self, on):
+        """Switch the USB connection to Neato off or on, without waiting.
+
+        Reboots after switching on if reboot_after_usb_switch is set.
+        """
+        state = '1' if on else '0'
+        if self.trace is not None:
+            self.trace.record(EVENT, 'usb on' if on else 'usb off')
+        if not on:
+            self.version = None
+            self.metrics.inc('neato_usb_toggles_total')
+        if self.config['usb_switch_mode'] == 'direct':
             self.log.debug("Direct connection specified.")
             print("Direct connection specified.")
-            # disable and re-enable usb ports to trigger clean
-            os.system('sudo ./hub-ctrl -h 0 -P 2 -p 0 ; sleep 1; '
-                      + 'sudo ./hub-ctrl -h 0 -P 2 -p 1 ')
-        elif settings['serial']['usb_switch_mode'] == 'relay':
+            # disable or re-enable usb ports to trigger clean
+            os.system('sudo ./hub-ctrl -h '
+                      + str(self.config.get('usb_hub', 0)) + ' -P '
+                      + str(self.config.get('usb_port', 2)) + ' -p ' + state)
+        elif self.config['usb_switch_mode'] == 'relay':
             print("Relay connection specified.")
             self.log.debug("Relay connection specified")
             # use relay to temporarily disconnect neato to trigger clean
-            GPIO.output(self.pin, GPIO.LOW)
-            time.sleep(1)
-            GPIO.output(self.pin, GPIO.HIGH)
-            print("Relay toggled.")
-        if settings['serial']['reboot_after_usb_switch']:
+            self.GPIO.output(self.pin,
+                             self.GPIO.HIGH if on else self.GPIO.LOW)
+            print("Relay switched.")
+        if on and self.config['reboot_after_usb_switch']:
             os.system('sudo reboot')
-        print("Leaving TOGGLEUSB()")
 
     def reconnect(self):
-        """Close and reconnect connection to Neato."""
+        """Close and reconnect connection to Neato.
+
+        Retries with exponential backoff and jitter until Neato is back,
+        possibly under another device, or reconnect_timeout_seconds passed.
+        """
         print("Entering RECONNECT()")
         self.log.debug("Reconnecting to Neato")
         print("Reconnecting to Neato")
+        self.metrics.inc('neato_reconnects_total')
         self.isConnected = False
-        time.sleep(5)
+        self.version = None
         self.close()
+        deadline = time.monotonic() + self.reconnect_timeout
+        delay = self.reconnect_initial
         self.isConnected = self.connect()
-        self.open()
+        while not self.isConnected and time.monotonic() < deadline:
+            # full jitter, so several robots on one host do not retry in step
+            self.metrics.sleep(random.uniform(0, delay), 'reconnect')
+            delay = min(delay * 2, self.reconnect_max)
+            self.isConnected = self.connect()
         print("Leaving RECONNECT(),  isConnected = "+str(self.isConnected))
 
     def handleCleanMessage(self, msg):
@@ -120,9 +277,8 @@ class NeatoSerial:
         self.toggleusb()
         # the device might have changed with the usb toggle,
         # so let's close and reconnect
-        time.sleep(1)
         self.reconnect()
-        time.sleep(10)
+        self.metrics.sleep(10, 'handleCleanMessage')
         # we might have to send the message twice to start the actual cleaning
         #if self.getIsConnected() and not self.getCleaning():
         #    out = self.raw_write(msg)
@@ -132,79 +288,239 @@ class NeatoSerial:
         print("Leaving HANDLECLEANMESSAGE(), out="+str(out)[:10])
         return out
 
-    def raw_write(self,msg):
-        """Write message to serial and return output."""
-        print("Entering RAW_WRITE(), msg = "+str(msg))
+    def raw_write(self, msg, timeout=None):
+        """Write message to serial and return output.
+
+        timeout is how long to wait for the response, command_timeout_seconds
+        by default.
+        """
         out = ''
         if self.isConnected:
+            command = msg.split(' ')[0]
+            start = time.perf_counter()
             inp = msg+"\n"
+            # whatever is waiting belongs to an earlier command
+            self.ser.flushInput()
             self.ser.write(inp.encode('utf-8'))
-            time.sleep(1)
-            while self.ser.inWaiting() > 0:
-                out += self.read_all(self.ser).decode('utf-8')
-        print("Leaving RAW_WRITE()")
+            if self.trace is not None:
+                self.trace.record(TX, command, inp.encode('utf-8'))
+            self.metrics.inc('neato_commands_total', command=command)
+            self.metrics.inc('neato_bytes_sent_total', len(inp))
+            if self.framing == 'terminator':
+                self.read_response(timeout, echo=msg)
+            else:
+                self.metrics.sleep(1, 'raw_write')
+                self.rxlen = 0
+                while self.ser.inWaiting() > 0:
+                    self.read_all(self.ser)
+            latency = time.perf_counter() - start
+            self.metrics.observe('neato_command_seconds', latency,
+                                 command=command)
+            self.metrics.inc('neato_bytes_received_total', self.rxlen)
+            if self.trace is not None:
+                self.trace.record(RX, command, self.received(), latency)
+            # decode once, the raw bytes stay available through received()
+            out = str(self.received(), 'utf-8')
+            if out != '':
+                self.lastActive = time.monotonic()
+            else:
+                self.metrics.inc('neato_empty_responses_total',
+                                 command=command)
         return out
 
-    def write(self, msg):
-        """Write message to serial and return output. Handles Clean message."""
-        print("Entering WRITE, msg = "+msg)
-        self.log.debug("Message received for writing: "+msg)
-        if self.isConnected:
-            # wake up neato by sending something random
-            try:
-                print("Sending Wake-up msg.")
-                out = self.raw_write("wake-up")
-                # now send the real message
-                if msg.startswith("Clean"):
-                    out = self.handleCleanMessage(msg)
-                else:
-                    out = self.raw_write(msg)
-                if out is not '':
-                    print("Leaving WRITE(), out = "+str(out)[:10])
-                    return out
-            except OSError as ex:
-                self.log.error("Exception in 'write' method: "+str(ex))
-                print("Exception in WRITE(): "+str(ex))
-                print("Calling RECONNECT()")
-                self.reconnect()
+    def wakeUp(self):
+        """Wake up neato by sending something random.
+
+        A dozing neato does not answer it, so the response is only waited
+        for as long as the port timeout, not the whole command timeout.
+        """
+        self.metrics.inc('neato_wakeups_total')
+        self.raw_write("wake-up", float(self.config['timeout_seconds']))
+
+    def write(self, msg, toggle=True):
+        """Write message to serial and return output. Handles Clean message.
+
+        Clean commands are followed by a USB toggle and reconnect, which
+        takes a while. Pass toggle=False to only send them, e.g. when
+        neatoclean.CleanWorkflow takes care of the rest.
+        """
+        with self.metrics.timer('neato_write_seconds',
+                                command=msg.split(' ')[0]):
+            self.log.debug("Message received for writing: "+msg)
+            if not msg.startswith("Get"):
+                # anything but a query may change what Neato reports
+                self.snapshot = {}
+            if self.isConnected:
+                try:
+                    woken = False
+                    if self.isIdle():
+                        self.wakeUp()
+                        woken = True
+                    # now send the real message
+                    if msg.startswith("Clean") and toggle:
+                        out = self.handleCleanMessage(msg)
+                    else:
+                        out = self.raw_write(msg)
+                        if out == '' and not woken:
+                            # neato might have dozed off, wake it up and retry
+                            self.wakeUp()
+                            out = self.raw_write(msg)
+                    if out != '':
+                        return out
+                except OSError as ex:
+                    self.metrics.inc('neato_errors_total', method='write')
+                    self.log.error("Exception in 'write' method: "+str(ex))
+                    print("Exception in WRITE(): "+str(ex))
+                    if self.trace is not None:
+                        self.trace.freeze(str(ex))
+                    self.reconnect()
+            else:
+                print("Not connected in WRITE() - calling CONNECT()")
+                self.isConnected = self.connect()
+
+    @contextmanager
+    def poll(self):
+        """Send every query command at most once within this context.
+
+        Getters deriving their value from the same command (e.g. the battery
+        level and docked state from GetCharger) share a single round trip:
+
+            with ns.poll():
+                level = ns.getBatteryLevel()
+                docked = ns.getExtPwrPresent()
+        """
+        if self.pollDepth == 0:
+            self.snapshot = {}
+        self.pollDepth += 1
+        try:
+            yield self
+        finally:
+            self.pollDepth -= 1
+
+    def query(self, msg):
+        """Write a query command and return its parsed output.
+
+        Reuses the snapshot answer if available. The output is parsed by the
+        parser registered for the command in neatoparsers, or by
+        parseOutput if there is none.
+        """
+        cached = self.snapshot.get(msg)
+        if cached is not None:
+            stamp, out = cached
+            if (self.pollDepth > 0 or
+                    time.monotonic() - stamp <= self.snapshot_ttl):
+                return out
+        raw = self.write(msg)
+        if msg.split(' ')[0] in PARSERS:
+            out = parse(msg, raw)
         else:
-            print("Not connected in WRITE() - calling CONNECT()")
-            self.isConnected = self.connect()
+            out = self.parseOutput(raw)
+        if raw is not None:
+            # also keep answers that parse to None, like GetErr without error
+            self.snapshot[msg] = (time.monotonic(), out)
+        return out
 
-    def getError(self):
-        """Return error message if available."""
-        print("Entering GETERROR()")
-        output = self.write("GetErr")
-        if output is not None:
-            outputsplit = output.split('\r\n')
-            if len(outputsplit) == 3:
-                err = outputsplit[1]
-                if ' - ' in err:
-                    errsplit = err.split(' - ')
-                    # if err is 220 (unplug usb before cleaning) handle it
-                    self.log.debug("Errorcode is 220")
-                    print("Errorcode is 220")
-                    if int(errsplit[0]) == 220:
-                        print("Toggling USB")
-                        self.toggleusb()
-                        print("Reconnecting")
-                        self.reconnect()
-                        print("!!!Calling RAW_WRITE('CLEAN').")
-                        self.raw_write("Clean")
-                    print("Leaving GETERROR(), errsplit = "+str(errsplit))
-                    return errsplit[0], errsplit[1]
+    def batch(self, msgs):
+        """Send several query commands in one exchange.
+
+        The commands are written back to back and the responses are split on
+        their terminators and matched to the commands by their echoed first
+        line. Returns the parsed output of every command, like query(), and
+        keeps them in the snapshot so getters within poll() reuse them.
+        """
+        for msg in msgs:
+            if not msg.startswith("Get"):
+                raise ValueError("Only query commands can be batched: "+msg)
+        if self.framing != 'terminator' or not self.isConnected:
+            return [self.query(msg) for msg in msgs]
+        send = list(msgs)
+        if self.isIdle():
+            # the wake-up rides along in the same exchange
+            self.metrics.inc('neato_wakeups_total')
+            send.insert(0, "wake-up")
+        try:
+            start = time.perf_counter()
+            inp = "\n".join(send)+"\n"
+            # whatever is waiting belongs to an earlier command
+            self.ser.flushInput()
+            self.ser.write(inp.encode('utf-8'))
+            if self.trace is not None:
+                self.trace.record(TX, 'batch', inp.encode('utf-8'))
+            for msg in send:
+                self.metrics.inc('neato_commands_total',
+                                 command=msg.split(' ')[0])
+            self.metrics.inc('neato_bytes_sent_total', len(inp))
+            # a late reply to the wake-up is dropped like a stale one
+            self.read_response(self.command_timeout * len(send), len(msgs),
+                               msgs[0])
+            latency = time.perf_counter() - start
+            self.metrics.observe('neato_command_seconds', latency,
+                                 command='batch')
+            self.metrics.inc('neato_bytes_received_total', self.rxlen)
+            if self.trace is not None:
+                self.trace.record(RX, 'batch', self.received(), latency)
+        except OSError as ex:
+            self.metrics.inc('neato_errors_total', method='batch')
+            self.log.error("Exception in 'batch' method: "+str(ex))
+            if self.trace is not None:
+                self.trace.freeze(str(ex))
+            self.reconnect()
+            return [None] * len(msgs)
+        responses = {}
+        for response in str(self.received(), 'utf-8').split(
+                RESPONSE_TERMINATOR.decode('ascii')):
+            echo = response.lstrip().split('\r\n', 1)[0].strip()
+            responses[echo.lower()] = response
+        if any(msg.lower() in responses for msg in send):
+            # Neato answered, an empty buffer still splits into one response
+            self.lastActive = time.monotonic()
+        results = []
+        for msg in msgs:
+            out = responses.get(msg.lower())
+            if out is None:
+                self.log.debug("No response to "+msg+" in batch")
+                results.append(None)
+                continue
+            if msg.split(' ')[0] in PARSERS:
+                out = parse(msg, out)
             else:
-                print("Leaving GETERROR(), return None since no output split.")
-                return None
-        else:
-            print("Leaving GETERROR(), return None since Output is None.")
+                out = self.parseOutput(out)
+            self.snapshot[msg] = (time.monotonic(), out)
+            results.append(out)
+        return results
+
+    def isIdle(self):
+        """Return true if the link was quiet long enough to need a wake-up."""
+        return (self.lastActive is None or
+                time.monotonic() - self.lastActive > self.wakeup_idle)
+
+    def getError(self):
+        """Return error code and message if available."""
+        error = self.query("GetErr")
+        if error is None:
             return None
+        # if err is 220 (unplug usb before cleaning) handle it
+        if error.code == 220:
+            self.log.debug("Errorcode is 220")
+            print("Errorcode is 220")
+            if self.trace is not None:
+                self.trace.freeze('error 220')
+            if self.unplugUsbHandler is not None:
+                self.unplugUsbHandler()
+                return error
+            print("Toggling USB")
+            self.toggleusb()
+            print("Reconnecting")
+            self.reconnect()
+            print("!!!Calling RAW_WRITE('CLEAN').")
+            self.raw_write("Clean")
+        return error
 
     def getBatteryLevel(self):
         """Return battery level."""
         charger = self.getCharger()
         if charger:
-            return int(charger.get("FuelPercent", 0))
+            return charger.get("FuelPercent", 0)
         else:
             return 0
 
@@ -212,7 +528,7 @@ class NeatoSerial:
         """Return true if device is currently charging."""
         charger = self.getCharger()
         if charger:
-            return bool(int(charger.get("ChargingActive", False)))
+            return bool(charger.get("ChargingActive", False))
         else:
             return False
 
@@ -220,65 +536,107 @@ class NeatoSerial:
         """Return true if device is currently docked."""
         charger = self.getCharger()
         if charger:
-            return bool(int(charger.get("ExtPwrPresent", False)))
+            return bool(charger.get("ExtPwrPresent", False))
         else:
             return False
 
     def getAccel(self):
         """Get accelerometer info."""
-        return self.parseOutput(self.write("GetAccel"))
+        return self.query("GetAccel")
 
     def getAnalogSensors(self):
         """Get analog sensor info."""
-        return self.parseOutput(self.write("GetAnalogSensors"))
+        return self.query("GetAnalogSensors")
 
     def getButtons(self):
         """Get button info."""
-        return self.parseOutput(self.write("GetButtons"))
+        return self.query("GetButtons")
 
     def getCalInfo(self):
         """Get calibration info."""
-        return self.parseOutput(self.write("GetCalInfo"))
+        return self.query("GetCalInfo")
 
     def getCharger(self):
         """Get charger info."""
-        return self.parseOutput(self.write("GetCharger"))
+        return self.query("GetCharger")
 
     def getDigitalSensors(self):
         """Get digital sensor info."""
-        return self.parseOutput(self.write("GetDigitalSensors"))
+        return self.query("GetDigitalSensors")
 
     def getLDSScan(self):
-        """Get lidar scan."""
-        return self.parseOutput(self.write("GetLDSScan"))
+        """Get lidar scan as a neatolds.LDSScan."""
+        if self.write("GetLDSScan") is None:
+            return None
+        # parse straight from the receive buffer
+        return parse("GetLDSScan", self.received())
+
+    def startLDS(self):
+        """Spin up the lidar. Neato only allows this in test mode."""
+        self.write("TestMode On")
+        self.write("SetLDSRotation On")
+
+    def stopLDS(self):
+        """Spin down the lidar and leave test mode."""
+        self.write("SetLDSRotation Off")
+        self.write("TestMode Off")
+
+    def streamLDS(self, count=None, running=None):
+        """Spin up the lidar once and yield scans back to back.
+
+        Stops after count scans, when the generator is closed or, if given,
+        once running() returns false. The lidar is always spun down again.
+        While no scans come back, e.g. when disconnected, waits longer and
+        longer before asking again.
+        """
+        # like the parser, only imported when scanning, for NumPy
+        from neatolds import RETRY_INITIAL, RETRY_MAX
+        self.startLDS()
+        try:
+            n = 0
+            delay = RETRY_INITIAL
+            while ((count is None or n < count) and
+                   (running is None or running())):
+                scan = self.getLDSScan()
+                if scan is None:
+                    self.metrics.sleep(delay, 'streamLDS')
+                    delay = min(delay * 2, RETRY_MAX)
+                    continue
+                delay = RETRY_INITIAL
+                n += 1
+                yield scan
+        finally:
+            self.stopLDS()
 
     def getMotors(self):
         """Get motor info."""
-        return self.parseOutput(self.write("GetMotors"))
+        return self.query("GetMotors")
 
     def getSerialNumber(self):
         serialNum = self.getVersion()
-        if serialNum:
-            return serialNum.get("Serial Number", "1234")
+        if serialNum and "Serial Number" in serialNum:
+            return str(serialNum["Serial Number"].major)
         else:
             return str(1234)
 
     def getSoftwareVersion(self):
         softwareVer = self.getVersion()
-        if softwareVer:
-            return softwareVer.get("MainBoard Software", "1234")
+        if softwareVer and "MainBoard Software" in softwareVer:
+            return str(softwareVer["MainBoard Software"].major)
         else:
             return str(1234)
 
     def getVersion(self):
-        """Get version info."""
-        return self.parseOutput(self.write("GetVersion"))
+        """Get version info, cached for as long as the connection is up."""
+        if not self.version:
+            self.version = self.query("GetVersion")
+        return self.version
 
     def getVacuumRPM(self):
         """Get vacuum RPM."""
         motors = self.getMotors()
         if motors:
-            return int(motors.get("Vacuum_RPM", 0))
+            return motors.get("Vacuum_RPM", 0)
         else:
             return 0
 
@@ -287,7 +645,10 @@ class NeatoSerial:
         return self.getVacuumRPM() > 0
 
     def parseOutput(self, output):
-        """Parse the raw output of the serial port into a dictionary."""
+        """Parse the raw output of the serial port into a dictionary.
+
+        Only used for commands without a typed parser in neatoparsers.
+        """
         if output is None:
             return None
         else:
@@ -0,0 +1,410 @@
+"""asyncio serial interface for Neato."""
+from config import settings
+import serial
+import os
+import random
+import time
+import asyncio
+import logging
+from neatoparsers import PARSERS, parse
+from neatoserial import NeatoSerial, RESPONSE_TERMINATOR, echo_of
+from neatotrace import open_trace, TX, RX
+from neatotransport import find_devices
+
+
+class AsyncNeatoSerial:
+    """asyncio serial interface to Neato.
+
+    Offers the same getters as NeatoSerial, as coroutines. The port is read
+    without blocking through an event loop reader on its file descriptor,
+    all waits are awaitable and every command can be given a timeout, after
+    which it is cancelled:
+
+        ns = AsyncNeatoSerial()
+        await ns.connect()
+        level = await ns.getBatteryLevel()
+    """
+
+    def __init__(self, config=None):
+        """Initialize asyncio serial interface. Call connect() to connect.
+
+        config defaults to the serial section of the settings.
+        """
+        self.log = logging.getLogger(__name__)
+        self.config = settings['serial'] if config is None else config
+        self.framing = self.config.get('response_framing', 'terminator')
+        self.command_timeout = float(
+            self.config.get('command_timeout_seconds', 2))
+        self.wakeup_idle = float(
+            self.config.get('wakeup_idle_seconds', 30))
+        self.lastActive = None
+        self.snapshot_ttl = float(
+            self.config.get('snapshot_ttl_seconds', 0))
+        self.snapshot = {}
+        self.pollDepth = 0
+        self.version = None
+        self.ser = None
+        self.isConnected = False
+        self.rxbuf = bytearray()
+        self.dataReceived = asyncio.Event()
+        # one command at a time on the wire
+        self.lock = asyncio.Lock()
+        # optional wire-level trace, see neatotrace
+        self.trace = open_trace(self.config)
+        self.reconnect_initial = float(
+            self.config.get('reconnect_initial_seconds', 0.05))
+        self.reconnect_max = float(
+            self.config.get('reconnect_max_seconds', 0.2))
+        self.reconnect_timeout = float(
+            self.config.get('reconnect_timeout_seconds', 60))
+        if self.config['usb_switch_mode'] == 'relay':
+            # use relay to temporarily disconnect neato to trigger clean,
+            # only imported here since it is only available on a Pi
+            import RPi.GPIO as GPIO
+            self.GPIO = GPIO
+            self.pin = int(self.config['relay_gpio'])
+            GPIO.setmode(GPIO.BCM)
+            GPIO.setwarnings(False)
+            GPIO.setup(self.pin, GPIO.OUT)
+            GPIO.output(self.pin, GPIO.HIGH)
+
+    # the snapshot and parsing logic is shared with NeatoSerial
+    poll = NeatoSerial.poll
+    isIdle = NeatoSerial.isIdle
+    parseOutput = NeatoSerial.parseOutput
+
+    async def connect(self):
+        """Connect to serial port."""
+        self.lastActive = None
+        self.version = None
+        for dev in find_devices(self.config):
+            try:
+                # a timeout of 0 makes reads return immediately
+                self.ser = serial.Serial(dev, 115200,
+                                         serial.EIGHTBITS, serial.PARITY_NONE,
+                                         serial.STOPBITS_ONE, 0)
+                self.ser.reset_input_buffer()
+                self.rxbuf.clear()
+                asyncio.get_running_loop().add_reader(self.ser.fileno(),
+                                                      self.onReadable)
+                self.log.debug("Connected to Neato at "+dev)
+                self.isConnected = True
+                return True
+            except (OSError, serial.SerialException) as ex:
+                self.log.error("Could not connect to device "+dev+": "
+                               + str(ex)+". Trying next device.")
+        self.isConnected = False
+        return False
+
+    def getIsConnected(self):
+        """Return if connected."""
+        return self.isConnected
+
+    def close(self):
+        """Close serial port."""
+        if self.ser is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self.ser.fileno())
+            except (OSError, ValueError, RuntimeError):
+                # port already gone or no loop running any more
+                pass
+            self.ser.close()
+        self.isConnected = False
+
+    def onReadable(self):
+        """Move waiting bytes from the port into the receive buffer."""
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except (OSError, serial.SerialException) as ex:
+            self.log.error("Error reading from Neato: "+str(ex))
+            asyncio.get_running_loop().remove_reader(self.ser.fileno())
+            self.isConnected = False
+            data = b''
+        self.rxbuf += data
+        self.dataReceived.set()
+
+    async def read_response(self, echo=None):
+        """Wait for a complete response and take it from the buffer.
+
+        With echo, responses that do not echo it, like the late response
+        to a command that timed out or was cancelled, are thrown away.
+        """
+        while True:
+            end = self.rxbuf.find(RESPONSE_TERMINATOR)
+            if end >= 0:
+                out = bytes(self.rxbuf[:end])
+                del self.rxbuf[:end + 1]
+                if echo is None or echo_of(out[:256]) == echo.strip().lower():
+                    return out
+                self.log.debug("Dropped stale response "+repr(out[:40]))
+                continue
+            if not self.isConnected:
+                raise OSError("Connection to Neato lost")
+            self.dataReceived.clear()
+            await self.dataReceived.wait()
+
+    async def toggleusb(self):
+        """Toggle USB connection to Neato."""
+        self.version = None
+        if self.config['usb_switch_mode'] == 'direct':
+            self.log.debug("Direct connection specified.")
+            # disable and re-enable usb ports to trigger clean
+            for state in ('0', '1'):
+                proc = await asyncio.create_subprocess_shell(
+                    'sudo ./hub-ctrl -h ' + str(self.config.get('usb_hub', 0))
+                    + ' -P ' + str(self.config.get('usb_port', 2))
+                    + ' -p ' + state)
+                await proc.wait()
+                if state == '0':
+                    await asyncio.sleep(1)
+        elif self.config['usb_switch_mode'] == 'relay':
+            self.log.debug("Relay connection specified")
+            # use relay to temporarily disconnect neato to trigger clean
+            self.GPIO.output(self.pin, self.GPIO.LOW)
+            await asyncio.sleep(1)
+            self.GPIO.output(self.pin, self.GPIO.HIGH)
+        if self.config['reboot_after_usb_switch']:
+            os.system('sudo reboot')
+
+    async def reconnect(self):
+        """Close and reconnect connection to Neato.
+
+        Retries with exponential backoff and jitter, see
+        NeatoSerial.reconnect.
+        """
+        self.log.debug("Reconnecting to Neato")
+        self.isConnected = False
+        self.version = None
+        self.close()
+        deadline = time.monotonic() + self.reconnect_timeout
+        delay = self.reconnect_initial
+        while (not await self.connect() and
+               time.monotonic() < deadline):
+            await asyncio.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, self.reconnect_max)
+
+    async def handleCleanMessage(self, msg):
+        """Handle sending and extra activities for Clean messages."""
+        out = await self.raw_write(msg)
+        self.log.debug("Message started with 'Clean' so toggling USB")
+        await self.toggleusb()
+        # the device might have changed with the usb toggle,
+        # so let's close and reconnect
+        await self.reconnect()
+        await asyncio.sleep(10)
+        return out
+
+    async def raw_write(self, msg, timeout=None):
+        """Write message to serial and return output.
+
+        timeout is how long to wait for the response, command_timeout_seconds
+        by default.
+        """
+        if timeout is None:
+            timeout = self.command_timeout
+        out = ''
+        if self.isConnected:
+            # drop leftovers of an earlier, cancelled command
+            self.rxbuf.clear()
+            command = msg.split(' ')[0]
+            start = time.perf_counter()
+            self.ser.write((msg+"\n").encode('utf-8'))
+            if self.trace is not None:
+                self.trace.record(TX, command, (msg+"\n").encode('utf-8'))
+            if self.framing == 'terminator':
+                try:
+                    out = (await asyncio.wait_for(
+                        self.read_response(msg),
+                        timeout)).decode('utf-8')
+                except asyncio.TimeoutError:
+                    self.log.debug("No response terminator received within "
+                                   + str(timeout) + " seconds")
+                    # only a partial response to this command is of use
+                    out = (self.rxbuf.decode('utf-8')
+                           if echo_of(self.rxbuf[:256]) == msg.strip().lower()
+                           else '')
+            else:
+                await asyncio.sleep(1)
+                out = self.rxbuf.decode('utf-8')
+            self.rxbuf.clear()
+            if self.trace is not None:
+                self.trace.record(RX, command, out.encode('utf-8'),
+                                  time.perf_counter() - start)
+            if out != '':
+                self.lastActive = time.monotonic()
+        return out
+
+    async def wakeUp(self):
+        """Wake up neato by sending something random.
+
+        A dozing neato does not answer it, so the response is only waited
+        for as long as the port timeout, not the whole command timeout.
+        """
+        await self.raw_write("wake-up", float(self.config['timeout_seconds']))
+
+    async def write(self, msg, timeout=None):
+        """Write message to serial and return output. Handles Clean message.
+
+        If timeout is given, the command is cancelled after that many
+        seconds and asyncio.TimeoutError is raised.
+        """
+        if timeout is not None:
+            return await asyncio.wait_for(self.write(msg), timeout)
+        self.log.debug("Message received for writing: "+msg)
+        if not msg.startswith("Get"):
+            # anything but a query may change what Neato reports
+            self.snapshot = {}
+        if not self.isConnected:
+            self.log.debug("Not connected in write() - connecting")
+            await self.connect()
+            return None
+        async with self.lock:
+            try:
+                woken = False
+                if self.isIdle():
+                    await self.wakeUp()
+                    woken = True
+                if msg.startswith("Clean"):
+                    out = await self.handleCleanMessage(msg)
+                else:
+                    out = await self.raw_write(msg)
+                    if out == '' and not woken:
+                        # neato might have dozed off, wake it up and retry
+                        await self.wakeUp()
+                        out = await self.raw_write(msg)
+                if out != '':
+                    return out
+            except OSError as ex:
+                self.log.error("Exception in 'write' method: "+str(ex))
+                if self.trace is not None:
+                    self.trace.freeze(str(ex))
+                await self.reconnect()
+        return None
+
+    async def query(self, msg):
+        """Write a query command and return its parsed output.
+
+        Reuses the snapshot answer if available, see NeatoSerial.query.
+        """
+        cached = self.snapshot.get(msg)
+        if cached is not None:
+            stamp, out = cached
+            if (self.pollDepth > 0 or
+                    time.monotonic() - stamp <= self.snapshot_ttl):
+                return out
+        raw = await self.write(msg)
+        if msg.split(' ')[0] in PARSERS:
+            out = parse(msg, raw)
+        else:
+            out = self.parseOutput(raw)
+        if raw is not None:
+            # also keep answers that parse to None, like GetErr without error
+            self.snapshot[msg] = (time.monotonic(), out)
+        return out
+
+    async def getError(self):
+        """Return error code and message if available."""
+        error = await self.query("GetErr")
+        if error is None:
+            return None
+        # if err is 220 (unplug usb before cleaning) handle it
+        if error.code == 220:
+            self.log.debug("Errorcode is 220")
+            if self.trace is not None:
+                self.trace.freeze('error 220')
+            await self.toggleusb()
+            await self.reconnect()
+            async with self.lock:
+                await self.raw_write("Clean")
+        return error
+
+    async def getBatteryLevel(self):
+        """Return battery level."""
+        charger = await self.getCharger()
+        if charger:
+            return charger.get("FuelPercent", 0)
+        else:
+            return 0
+
+    async def getChargingActive(self):
+        """Return true if device is currently charging."""
+        charger = await self.getCharger()
+        if charger:
+            return bool(charger.get("ChargingActive", False))
+        else:
+            return False
+
+    async def getExtPwrPresent(self):
+        """Return true if device is currently docked."""
+        charger = await self.getCharger()
+        if charger:
+            return bool(charger.get("ExtPwrPresent", False))
+        else:
+            return False
+
+    async def getAccel(self):
+        """Get accelerometer info."""
+        return await self.query("GetAccel")
+
+    async def getAnalogSensors(self):
+        """Get analog sensor info."""
+        return await self.query("GetAnalogSensors")
+
+    async def getButtons(self):
+        """Get button info."""
+        return await self.query("GetButtons")
+
+    async def getCalInfo(self):
+        """Get calibration info."""
+        return await self.query("GetCalInfo")
+
+    async def getCharger(self):
+        """Get charger info."""
+        return await self.query("GetCharger")
+
+    async def getDigitalSensors(self):
+        """Get digital sensor info."""
+        return await self.query("GetDigitalSensors")
+
+    async def getLDSScan(self):
+        """Get lidar scan as a neatolds.LDSScan."""
+        out = await self.write("GetLDSScan")
+        return parse("GetLDSScan", out)
+
+    async def getMotors(self):
+        """Get motor info."""
+        return await self.query("GetMotors")
+
+    async def getSerialNumber(self):
+        """Return the serial number."""
+        serialNum = await self.getVersion()
+        if serialNum and "Serial Number" in serialNum:
+            return str(serialNum["Serial Number"].major)
+        else:
+            return str(1234)
+
+    async def getSoftwareVersion(self):
+        """Return the main board software version."""
+        softwareVer = await self.getVersion()
+        if softwareVer and "MainBoard Software" in softwareVer:
+            return str(softwareVer["MainBoard Software"].major)
+        else:
+            return str(1234)
+
+    async def getVersion(self):
+        """Get version info, cached for as long as the connection is up."""
+        if not self.version:
+            self.version = await self.query("GetVersion")
+        return self.version
+
+    async def getVacuumRPM(self):
+        """Get vacuum RPM."""
+        motors = await self.getMotors()
+        if motors:
+            return motors.get("Vacuum_RPM", 0)
+        else:
+            return 0
+
+    async def getCleaning(self):
+        """Return true is device is currently cleaning."""
+        return await self.getVacuumRPM() > 0
@@ -3,7 +3,6 @@ from config import settings
 import serial
 import os
 import time
-import RPi.GPIO as GPIO
 import logging
 
 
@@ -1,160 +1,374 @@
+"""MQTT interface for Neato Serial.
 
-"""MQTT interface for Neato Serial."""
+Serves the Neato configured in the serial section, or in gateway mode every
+Neato listed in the robots section, over one MQTT connection.
+"""
 from config import settings
 import json
 import time
 import sys
+import threading
 import paho.mqtt.client as mqtt
 from neatoserial import NeatoSerial
+from neatopublish import PublishQueue
+from neatoworker import SerialWorker, PRIORITY_COMMAND
+from neatopoller import AdaptivePoller, METRIC_COMMANDS
+from neatoclean import CleanWorkflow, DONE, FAILED
+from neatometrics import metrics
+import itertools
 import logging
 
-ns = NeatoSerial()
-serial_number = ns.getSerialNumber()
-software_version = ns.getSoftwareVersion()
-is_docked = ns.getExtPwrPresent()
-is_cleaning = ns.getCleaning()
-is_charging = ns.getChargingActive()
-fan_speed = ns.getVacuumRPM()
-battery_level = ns.getBatteryLevel()
-error = ns.getError()
-
-#Function utilized when MQTT Autodiscovery is used - uses "state" schema in Homeassistant
-def discovery_payload():
-    config_data = {
-        'availability': [{'topic': 'neato_serial_' + serial_number +'/state'}],
-        'command_topic': settings['mqtt']['command_topic'],
-        'device': {
-            'identifiers': ['Neato_serial_' + serial_number],
-            'name': 'neato_serial_vacuum',
-            'manufacturer': 'Neato Robotics',
-            'model': 'XV Series',
-            'sw_version': software_version
-        },
-        'name': 'neato_serial_vacuum',
-        'unique_id': 'neato_serial_' + serial_number,
-        'payload_clean_spot': 'Clean Spot',
-        'payload_locate': 'PlaySound 19',
-        'payload_start': 'Clean',
-        'payload_stop': 'Clean Stop',
-        'schema': 'state',
-        'state_topic': settings['mqtt']['state_topic'],
-        'json_attributes_topic': 'vacuum/neato_serial_' + serial_number + '/attributes',
-        'supported_features': ['start', 'stop', 'battery', 'status', 'locate', 'clean_spot']
-    }
-    state_data = {}
-    attributes_data = {}
-    state_data["battery_level"] = battery_level
-    state_data["fan_speed"] = fan_speed
-    attributes_data["charging"] = is_charging
-    if is_docked:
-        state_data["state"] = "docked"
-    elif is_cleaning:
-        state_data["state"] = "cleaning"
-    elif error:
-        log.debug("Error from Neato: "+str(error[1]))
-        attributes_data["error"] = error[1]
-        state_data["state"] = "error"
-    else:
-        state_data["state"] = "idle"
-
-    #Convert config, state, and attributes payloads to json + publish them
-    json_config_data = json.dumps(config_data)
-    json_state_data = json.dumps(state_data)
-    json_attributes_data = json.dumps(attributes_data)
-    log.debug("Sending MQTT Config Message: "+str(json_config_data))
-    client.publish(settings['mqtt']['discovery_topic'] + '/vacuum/neato_serial_' + serial_number + '/config', json_config_data)
-    log.debug("Sending vacuum state message: "+str(json_state_data))
-    client.publish(settings['mqtt']['state_topic'], json_state_data)
-    log.debug("Sending vacuum attributes message: "+str(json_attributes_data))
-    client.publish('vacuum/neato_serial_' + serial_number + '/attributes', json_attributes_data)
-    time.sleep(settings['mqtt']['publish_wait_seconds'])
-
-#Function utilized when manual MQTT configuration is used - uses "legacy" schema in Homeassistant
-def legacy_payload():
-    legacy_data = {}
-    legacy_data["battery_level"] = battery_level
-    legacy_data["docked"] = is_docked
-    legacy_data["cleaning"] = is_cleaning
-    legacy_data["charging"] = is_charging
-    legacy_data["fan_speed"] = fan_speed
-    error = ns.getError()
-    if error:
-        log.debug("Error from Neato: "+str(error))
-        legacy_data["error"] = error[1]
-    json_legacy_data = json.dumps(legacy_data)
-    log.debug("Sending vacuum state message: "+str(json_legacy_data))
-    client.publish(settings['mqtt']['state_topic'], json_legacy_data)
-    time.sleep(settings['mqtt']['publish_wait_seconds'])
+# telemetry, name -> (metric it is derived from, NeatoSerial getter)
+TELEMETRY = {
+    'serial_number': ('version', NeatoSerial.getSerialNumber),
+    'software_version': ('version', NeatoSerial.getSoftwareVersion),
+    'is_docked': ('charger', NeatoSerial.getExtPwrPresent),
+    'is_cleaning': ('motors', NeatoSerial.getCleaning),
+    'is_charging': ('charger', NeatoSerial.getChargingActive),
+    'fan_speed': ('motors', NeatoSerial.getVacuumRPM),
+    'battery_level': ('charger', NeatoSerial.getBatteryLevel),
+    'error': ('error', NeatoSerial.getError),
+}
 
-def on_message(client, userdata, msg):
-    """Message received."""
-    inp = msg.payload.decode('ascii')
-    log.info("Message received: "+inp)
-    if 'discovery_topic' in settings['mqtt']:
-        if (inp == "Clean") or (inp == "Clean Spot"):
-            on_message_data={}
-            on_message_data["battery_level"] = battery_level
-            on_message_data["fan_speed"] = fan_speed
-            on_message_data["state"] = "cleaning"
-            json_on_message_data = json.dumps(on_message_data)
-            #Use secondary client connection to set state to cleaning before Pi reboots (Can't publish with primary client whithin callback function)
-            cleaning_client.publish(settings['mqtt']['state_topic'], json_on_message_data)
-            feedback = ns.write(inp)
-            log.info("Feedback from device: "+feedback)
-        elif inp == "Clean Stop":
-            on_message_data={}
-            on_message_data["battery_level"] = battery_level
-            on_message_data["fan_speed"] = fan_speed
-            on_message_data["state"] = "idle"
-            json_on_message_data = json.dumps(on_message_data)
-            #Use secondary client connection to set state to idle before Pi reboots (Can't publish with primary client whithin callback function)
-            cleaning_client.publish(settings['mqtt']['state_topic'], json_on_message_data)
-            feedback = ns.write(inp)
-            log.info("Feedback from device: "+feedback)
+def fetch_telemetry(neato, commands):
+    """Fetch the commands of a poll cycle in one batch."""
+    if neato.version:
+        commands = [command for command in commands if command != 'GetVersion']
+    return neato.batch(commands)
+
+def robot_configs():
+    """Return the serial settings of every robot to serve.
+
+    Every entry of the robots section overrides the serial section, without
+    a robots section only the serial section is used. A robot told apart
+    by serial_device only sticks to it, any port with Neato's USB id could
+    be another robot.
+    """
+    robots = settings.get('robots')
+    if not robots:
+        return [settings['serial']]
+    configs = []
+    for robot in robots:
+        config = dict(settings['serial'], **robot)
+        if 'serial_device' in robot and not config.get('usb_serial_number'):
+            config['usb_discovery'] = robot.get('usb_discovery', False)
+        configs.append(config)
+    return configs
+
+def namespaced(topic, serial_number):
+    """Insert the serial number before the last level of topic."""
+    base, _, name = topic.rpartition('/')
+    return (base + '/' if base else '') + serial_number + '/' + name
+
+class Robot:
+    """One Neato with its own serial worker, polling schedule and state."""
+
+    def __init__(self, config, gateway=False):
+        """Initialize robot, gateway namespaces its topics by serial number.
+
+        Nothing is sent to Neato before start().
+        """
+        self.config = config
+        self.gateway = gateway
+        self.ns = None
+        self.worker = None
+        self.clean = None
+        self.sampler = None
+        self.poller = AdaptivePoller(settings['mqtt'].get('poll_intervals'))
+        self.cycles = itertools.count()
+        self.state = {name: None for name in TELEMETRY}
+        # topic -> (payload, time published), cleared on every broker connection
+        self.published = {}
+        self.command_topic = None
+        self.thread = None
+
+    def topic(self, name):
+        """Return the topic configured as name, namespaced in gateway mode."""
+        topic = self.config.get(name) or settings['mqtt'][name]
+        if self.gateway and name not in self.config:
+            topic = namespaced(topic, self.state['serial_number'])
+        return topic
+
+    def poll_state(self, due):
+        """Poll the telemetry derived from the due metrics through the worker.
+
+        Every value is a separate job so commands can overtake the poll,
+        while all jobs of the cycle still share one snapshot of the
+        underlying commands.
+        """
+        cycle = next(self.cycles)
+        commands = [METRIC_COMMANDS[metric] for metric in due]
+        self.worker.submit(lambda neato: fetch_telemetry(neato, commands),
+                           key='fetch_telemetry', cycle=cycle)
+        futures = {name: self.worker.submit(getter, key=name, cycle=cycle)
+                   for name, (metric, getter) in TELEMETRY.items()
+                   if metric in due}
+        return {name: future.result() for name, future in futures.items()}
+
+    def robot_state(self):
+        """Return the state the polling intervals are chosen by."""
+        if self.state['is_cleaning']:
+            return 'cleaning'
+        elif self.state['is_docked']:
+            return 'docked'
         else:
-            feedback = ns.write(inp)
-            log.info("Feedback from device: "+feedback)
-    else:
-        if (inp == "Clean") or (inp == "Clean Spot"):
-            on_message_data={}
-            on_message_data["battery_level"] = battery_level
-            on_message_data["docked"] = is_docked
-            on_message_data["cleaning"] = True
-            on_message_data["charging"] = is_charging
-            on_message_data["fan_speed"] = fan_speed
-            json_on_message_data = json.dumps(on_message_data)
-            #Use secondary client connection to set state to cleaning before Pi reboots (Can't publish with primary client whithin callback function)
-            cleaning_client.publish(settings['mqtt']['state_topic'], json_on_message_data)
-            feedback = ns.write(inp)
-            log.info("Feedback from device: "+feedback)
-        elif inp == "Clean Stop":
+            return 'idle'
+
+    def clean_progress(self, progress):
+        """Report progress of the Clean workflow."""
+        log.info("Clean workflow: "+json.dumps(progress))
+        if settings['mqtt'].get('clean_status_topic'):
+            publisher.publish(self.topic('clean_status_topic'),
+                              json.dumps(progress))
+        if progress['state'] in (DONE, FAILED):
+            #Pick up the new state of the robot right away
+            self.poller.trigger()
+
+    def send_command(self, inp):
+        """Send a command to Neato without waiting for it to finish."""
+        if inp.startswith("Clean"):
+            #Runs in steps on the worker, see neatoclean
+            self.clean.start(inp)
+            return
+        future = self.worker.write(inp, PRIORITY_COMMAND)
+        future.add_done_callback(log_feedback)
+        #Poll right after the command to pick up its effect
+        future.add_done_callback(lambda f: self.poller.trigger())
+
+    def publish_changed(self, topic, payload, heartbeat=True):
+        """Publish payload unless it is what was last published to topic.
+
+        Unchanged payloads are republished every heartbeat_seconds as a sign
+        of life, unless heartbeat is False. QoS and retain are set per topic
+        by the publish queue.
+        """
+        now = time.monotonic()
+        last = self.published.get(topic)
+        if (last is not None and last[0] == payload and
+                (not heartbeat or now - last[1] < heartbeat_seconds)):
+            return False
+        publisher.publish(topic, payload)
+        self.published[topic] = (payload, now)
+        return True
+
+    #Utilized when MQTT Autodiscovery is used - uses "state" schema in Homeassistant
+    def discovery_payload(self):
+        serial_number = self.state['serial_number']
+        error = self.state['error']
+        config_data = {
+            'availability': [{'topic': availability_topic},
+                             {'topic': 'neato_serial_' + serial_number +'/state'}],
+            'availability_mode': 'all',
+            'command_topic': self.topic('command_topic'),
+            'device': {
+                'identifiers': ['Neato_serial_' + serial_number],
+                'name': self.config.get('name', 'neato_serial_vacuum'),
+                'manufacturer': 'Neato Robotics',
+                'model': 'XV Series',
+                'sw_version': self.state['software_version']
+            },
+            'name': self.config.get('name', 'neato_serial_vacuum'),
+            'unique_id': 'neato_serial_' + serial_number,
+            'payload_clean_spot': 'Clean Spot',
+            'payload_locate': 'PlaySound 19',
+            'payload_start': 'Clean',
+            'payload_stop': 'Clean Stop',
+            'schema': 'state',
+            'state_topic': self.topic('state_topic'),
+            'json_attributes_topic': 'vacuum/neato_serial_' + serial_number + '/attributes',
+            'supported_features': ['start', 'stop', 'battery', 'status', 'locate', 'clean_spot']
+        }
+        state_data = {}
+        attributes_data = {}
+        state_data["battery_level"] = self.state['battery_level']
+        state_data["fan_speed"] = self.state['fan_speed']
+        attributes_data["charging"] = self.state['is_charging']
+        if self.state['is_docked']:
+            state_data["state"] = "docked"
+        elif self.state['is_cleaning']:
+            state_data["state"] = "cleaning"
+        elif error:
+            log.debug("Error from Neato: "+str(error[1]))
+            attributes_data["error"] = error[1]
+            state_data["state"] = "error"
+        else:
+            state_data["state"] = "idle"
+
+        #Convert config, state, and attributes payloads to json + publish them when changed
+        #The config is retained and only published once per broker connection
+        json_config_data = json.dumps(config_data)
+        json_state_data = json.dumps(state_data)
+        json_attributes_data = json.dumps(attributes_data)
+        if self.publish_changed(settings['mqtt']['discovery_topic'] + '/vacuum/neato_serial_' + serial_number + '/config', json_config_data, heartbeat=False):
+            log.debug("Sent MQTT Config Message: "+str(json_config_data))
+        if self.publish_changed(self.topic('state_topic'), json_state_data):
+            log.debug("Sent vacuum state message: "+str(json_state_data))
+        if self.publish_changed('vacuum/neato_serial_' + serial_number + '/attributes', json_attributes_data):
+            log.debug("Sent vacuum attributes message: "+str(json_attributes_data))
+
+    #Utilized when manual MQTT configuration is used - uses "legacy" schema in Homeassistant
+    def legacy_payload(self):
+        error = self.state['error']
+        legacy_data = {}
+        legacy_data["battery_level"] = self.state['battery_level']
+        legacy_data["docked"] = self.state['is_docked']
+        legacy_data["cleaning"] = self.state['is_cleaning']
+        legacy_data["charging"] = self.state['is_charging']
+        legacy_data["fan_speed"] = self.state['fan_speed']
+        if error:
+            log.debug("Error from Neato: "+str(error))
+            legacy_data["error"] = error[1]
+        json_legacy_data = json.dumps(legacy_data)
+        if self.publish_changed(self.topic('state_topic'), json_legacy_data):
+            log.debug("Sent vacuum state message: "+str(json_legacy_data))
+
+    def on_message(self, inp):
+        """Command received."""
+        log.info("Message received: "+inp)
+        if inp in ("Clean", "Clean Spot", "Clean Stop"):
+            cleaning = inp != "Clean Stop"
             on_message_data={}
-            on_message_data["battery_level"] = battery_level
-            on_message_data["docked"] = is_docked
-            on_message_data["cleaning"] = False
-            on_message_data["charging"] = is_charging
-            on_message_data["fan_speed"] = fan_speed
+            on_message_data["battery_level"] = self.state['battery_level']
+            if 'discovery_topic' in settings['mqtt']:
+                on_message_data["fan_speed"] = self.state['fan_speed']
+                on_message_data["state"] = "cleaning" if cleaning else "idle"
+            else:
+                on_message_data["docked"] = self.state['is_docked']
+                on_message_data["cleaning"] = cleaning
+                on_message_data["charging"] = self.state['is_charging']
+                on_message_data["fan_speed"] = self.state['fan_speed']
             json_on_message_data = json.dumps(on_message_data)
-            #Use secondary client connection to set state to cleaning before Pi reboots (Can't publish with primary client whithin callback function)
-            cleaning_client.publish(settings['mqtt']['state_topic'], json_on_message_data)
-            feedback = ns.write(inp)
-            log.info("Feedback from device: "+feedback)
+            #Set state right away, the publish queue sends it once this callback returns
+            publisher.publish(self.topic('state_topic'), json_on_message_data)
+            #Make sure the next polled state is published, even if unchanged
+            self.published.pop(self.topic('state_topic'), None)
+        self.send_command(inp)
+
+    def subscribe(self):
+        """Subscribe to the command topic, once the serial number is known."""
+        #Availability and progress are retained, so they are there for new subscribers
+        publisher.setPolicy('neato_serial_' + self.state['serial_number'] + '/state', 1, True)
+        if settings['mqtt'].get('clean_status_topic'):
+            publisher.setPolicy(self.topic('clean_status_topic'), 1, True)
+        self.command_topic = self.topic('command_topic')
+        robots_by_topic[self.command_topic] = self
+        client.subscribe(self.command_topic, qos=1)
+
+    def unplug_usb(self):
+        """Start the Clean workflow when Neato reports error 220.
+
+        Neato waits for its USB connection to go away to start cleaning.
+        Nothing is done while a workflow runs, it toggles USB itself.
+        """
+        if not self.clean.running():
+            log.info("Error 220 from "+self.name()+", starting Clean workflow")
+            self.clean.start("Clean")
+
+    def start(self):
+        """Start polling and publishing in a thread of its own."""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        """Connect to Neato and start its serial worker."""
+        self.ns = NeatoSerial(self.config)
+        #The worker thread is the only one talking to Neato
+        self.worker = SerialWorker(self.ns)
+        self.worker.start()
+        self.clean = CleanWorkflow(self.worker, self.config)
+        self.clean.listeners.append(self.clean_progress)
+        #Error 220 is left to the workflow, so it does not block the worker
+        self.ns.unplugUsbHandler = self.unplug_usb
+        if self.config.get('history_dir'):
+            #Imported here, NumPy is only needed when recording history
+            from neatohistory import open_history, HistorySampler
+            self.sampler = HistorySampler(self.worker, open_history(self.config),
+                                          self.config.get('history_interval_seconds', 10))
+            self.sampler.start()
+
+    def name(self):
+        """Return a name of the robot for the log."""
+        return str(self.config.get('name') or self.config.get('serial_device')
+                   or self.state['serial_number'])
+
+    def update(self):
+        """Poll the metrics that are due and publish the state.
+
+        Commands are subscribed to once a poll told the serial number. In
+        gateway mode nothing is published before, the topics are
+        namespaced by it. Returns False until then.
+        """
+        #Only poll the metrics that are due in the current state of the robot
+        if not self.ns.version:
+            self.poller.reset('version')
+        due = self.poller.due(self.robot_state())
+        if due:
+            self.state.update(self.poll_state(due))
+            self.poller.polled(due, self.robot_state())
+            self.poller.reschedule(self.robot_state())
+        if self.gateway and not self.ns.version:
+            log.info("Serial number of "+self.name()+" not known yet")
+            return False
+        if self.command_topic is None:
+            self.subscribe()
+        serial_number = self.state['serial_number']
+        self.publish_changed('neato_serial_' + serial_number +'/state', 'online', heartbeat=False)
+        if 'discovery_topic' in settings['mqtt']:
+            self.discovery_payload()
         else:
-            feedback = ns.write(inp)
-            log.info("Feedback from device: "+feedback)
+            self.legacy_payload()
+        return True
+
+    def run(self):
+        """Update until the process ends, backing off when that fails."""
+        self.connect()
+        delay = 1
+        while True:
+            try:
+                ok = self.update()
+            except Exception as ex:
+                #Keep serving the robot, whatever went wrong in this round
+                log.exception("Polling "+self.name()+" failed: "+str(ex))
+                ok = False
+            if ok:
+                delay = 1
+                self.poller.wait(self.robot_state())
+            else:
+                log.info("Retrying "+self.name()+" in "+str(delay)+" seconds")
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+
+def log_feedback(future):
+    """Log the output of a finished command."""
+    if future.exception() is not None:
+        log.error("Command failed: "+str(future.exception()))
+    else:
+        log.info("Feedback from device: "+str(future.result()))
+
+def on_message(client, userdata, msg):
+    """Message received, pass it on to the robot it is addressed to."""
+    robot = robots_by_topic.get(msg.topic)
+    if robot is not None:
+        robot.on_message(msg.payload.decode('ascii'))
 
 def on_connect(client, userdata, flags, rc):
     """Broker responded to connection request"""
     if rc == 0:
         log.info("Connection to broker successful")
+        #Publish config, availability and state afresh on every connection
+        publisher.publish(availability_topic, 'online')
+        for robot in robots:
+            robot.published.clear()
+            #Wake up the robot to publish now, not when the next metric is due
+            robot.poller.triggered.set()
+        for topic in list(robots_by_topic):
+            client.subscribe(topic, qos=1)
     else:
         log.info("Problem connecting to broker")
 
 def on_disconnect(client, userdata, rc):
     """Handle MQTT client disconnect."""
-    #Set availability to offline if disconnected from MQTT Broker
-    cleaning_client.publish('neato_serial_' + serial_number +'/state', 'offline', qos=0, retain=True)
-    client.loop_stop(force=False)
+    #The broker sets availability to offline through the last will
     if rc != 0:
         log.info("Unexpected disconnection.")
     else:
@@ -175,45 +389,42 @@ fh.setFormatter(formatter)
 log.addHandler(fh)
 
 log.debug("Starting")
-#Primary Client
+metrics_settings = settings.get('metrics') or {}
+metrics.start(metrics_settings)
+heartbeat_seconds = settings['mqtt'].get('heartbeat_seconds', 300)
+#Gateway mode when several robots are configured
+configs = robot_configs()
+# command topic -> robot
+robots_by_topic = {}
+robots = [Robot(config, gateway=bool(settings.get('robots')))
+          for config in configs]
+#One client for all robots, everything is published through the queue
+availability_topic = settings['mqtt'].get('availability_topic', 'neato_serial/state')
 client = mqtt.Client()
-#Secondary client that will handle publishing the "cleaning state" when on_message callback is called
-cleaning_client = mqtt.Client()
 client.on_message = on_message
 client.on_disconnect = on_disconnect
 client.on_connect = on_connect
 client.username_pw_set(settings['mqtt']['username'],
                        settings['mqtt']['password'])
-cleaning_client.username_pw_set(settings['mqtt']['username'],
-                       settings['mqtt']['password'])
+#The broker marks the gateway offline when the connection drops
+client.will_set(availability_topic, 'offline', qos=1, retain=True)
+publisher = PublishQueue(client, {availability_topic: (1, True)},
+                         float(settings['mqtt'].get('publish_batch_seconds', 0.1)))
+if 'discovery_topic' in settings['mqtt']:
+    publisher.setPolicy(settings['mqtt']['discovery_topic'] + '/#', 1, True)
+#Connect to the broker first, so availability is published right away
 log.debug("Connecting")
 client.connect(settings['mqtt']['host'], settings['mqtt']['port'])
-cleaning_client.connect(settings['mqtt']['host'], settings['mqtt']['port'])
-client.subscribe(settings['mqtt']['command_topic'], qos=1)
+publisher.start()
 log.debug("Setting up serial")
-
-
+#Every robot is polled concurrently, in its own thread, identity and state
+#are published as soon as they are known
+for robot in robots:
+    robot.start()
 log.debug("Ready")
-client.loop_start()
-cleaning_client.loop_start()
+#Diagnostics are shared by all robots
 while True:
-    # try:
-    #if not ns.getIsConnected():
-    #    ns.reconnect()
-    serial_number = ns.getSerialNumber()
-    software_version = ns.getSoftwareVersion()
-    is_docked = ns.getExtPwrPresent()
-    is_cleaning = ns.getCleaning()
-    is_charging = ns.getChargingActive()
-    fan_speed = ns.getVacuumRPM()
-    battery_level = ns.getBatteryLevel()
-    error = ns.getError()
-    #Determine whether end-user is using MQTT Autodiscovery or Manual configuration
-    if 'discovery_topic' in settings['mqtt']:
-        client.publish('neato_serial_' + serial_number +'/state', 'online', qos=0, retain=True)
-        discovery_payload()
-    else:
-        client.publish('neato_serial_' + serial_number +'/state', 'online', qos=0, retain=True)
-        legacy_payload()
-        # except Exception as ex:
-        #     log.error("Error getting status: "+str(ex))
+    if metrics_settings.get('mqtt_topic'):
+        publisher.publish(metrics_settings['mqtt_topic'],
+                          json.dumps(metrics.snapshot()))
+    time.sleep(float(metrics_settings.get('mqtt_interval_seconds', 15)))
@@ -0,0 +1,376 @@
+"""Simulated Neato on a pseudo-terminal, for running without a robot.
+
+Start the simulator and point serial_device in config.yaml to the device
+it prints (or to the path given with --link):
+
+    python3 neatosim.py --link /tmp/neato --latency 0.02
+
+Set usb_switch_mode to none when using the simulator, there is no USB
+connection to switch.
+"""
+import argparse
+import math
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+# the XV firmware ends every response with a Ctrl-Z
+RESPONSE_TERMINATOR = b'\x1a'
+
+ERROR_UNPLUG_USB = '220 - Unplug USB cable before cleaning.'
+
+# size of the simulated room in mm, with the robot starting in the middle
+ROOM_WIDTH = 4000
+ROOM_DEPTH = 3000
+
+# mm per second while cleaning
+CLEANING_SPEED = 200
+
+
+class NeatoSimulator:
+    """Emulate the XV command set on a pseudo-terminal.
+
+    Responses can be delayed (latency and jitter in seconds), garbled (noise
+    is the probability a response gets a corrupted byte) and dropped (drop
+    is the probability a response is never sent). Like the real robot, a
+    Clean command while USB is connected raises error 220 and only starts
+    cleaning once the link has been quiet for unplug_gap seconds, which is
+    what a USB toggle looks like from this side.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, noise=0.0, drop=0.0,
+                 unplug_gap=1.0, sleep_after=None, seed=None,
+                 serial_number='SIM00000AA'):
+        """Initialize simulator. Call start() to open the pseudo-terminal."""
+        self.serial_number = serial_number
+        self.latency = latency
+        self.jitter = jitter
+        self.noise = noise
+        self.drop = drop
+        self.unplug_gap = unplug_gap
+        self.sleep_after = sleep_after
+        self.random = random.Random(seed)
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.running = False
+        self.thread = None
+        self.lastCommand = time.monotonic()
+        self.commands = 0
+        # robot state
+        self.fuel = 80.0
+        self.docked = True
+        self.cleaning = False
+        self.cleanRequested = False
+        self.error = None
+        self.testMode = False
+        self.ldsRotating = False
+        self.leftWheel = 0.0
+        self.rightWheel = 0.0
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        self.lastUpdate = time.monotonic()
+
+    def start(self):
+        """Open the pseudo-terminal and start answering commands."""
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        """Stop answering commands and close the pseudo-terminal."""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        os.close(self.master)
+        os.close(self.slave)
+
+    def run(self):
+        """Read command lines and answer them."""
+        pending = b''
+        while self.running:
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                pending += os.read(self.master, 4096)
+            except OSError:
+                continue
+            while b'\n' in pending:
+                line, pending = pending.split(b'\n', 1)
+                self.handle(line.decode('utf-8', 'replace').strip())
+
+    def handle(self, cmd):
+        """Answer a single command line."""
+        now = time.monotonic()
+        quiet = now - self.lastCommand
+        self.lastCommand = now
+        self.commands += 1
+        self.update(now, quiet)
+        if self.sleep_after is not None and quiet > self.sleep_after:
+            # dozed off, this command only wakes the robot up
+            return
+        body = self.respond(cmd)
+        if self.random.random() < self.drop:
+            return
+        response = (cmd + '\r\n' + body).encode('utf-8')
+        if response and self.random.random() < self.noise:
+            garbled = bytearray(response)
+            position = self.random.randrange(len(garbled))
+            garbled[position] = self.random.randrange(32, 127)
+            response = bytes(garbled)
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        os.write(self.master, response + RESPONSE_TERMINATOR)
+
+    def update(self, now, quiet):
+        """Advance the robot state to now."""
+        elapsed = now - self.lastUpdate
+        self.lastUpdate = now
+        if self.cleanRequested and quiet >= self.unplug_gap:
+            # the USB link dropped, the robot starts cleaning
+            self.cleanRequested = False
+            self.error = None
+            self.cleaning = True
+            self.docked = False
+        if self.cleaning:
+            self.fuel = max(0.0, self.fuel - elapsed / 60)
+            self.drive(elapsed)
+        elif self.docked:
+            self.fuel = min(100.0, self.fuel + elapsed / 30)
+
+    def drive(self, elapsed):
+        """Drive straight ahead, turning away from walls."""
+        distance = CLEANING_SPEED * elapsed
+        nx = self.x + distance * math.cos(self.heading)
+        ny = self.y + distance * math.sin(self.heading)
+        if abs(nx) > ROOM_WIDTH / 2 - 200 or abs(ny) > ROOM_DEPTH / 2 - 200:
+            # turn on the spot, the wheels move in opposite directions
+            turn = math.pi / 2 + self.random.uniform(0, math.pi / 2)
+            self.heading = (self.heading + turn) % (2 * math.pi)
+            arc = turn * 125
+            self.leftWheel -= arc
+            self.rightWheel += arc
+        else:
+            self.x, self.y = nx, ny
+            self.leftWheel += distance
+            self.rightWheel += distance
+
+    def respond(self, cmd):
+        """Return the response body of a command."""
+        words = cmd.split()
+        name = words[0].lower() if words else ''
+        args = [word.lower() for word in words[1:]]
+        if name == 'getcharger':
+            return self.getCharger()
+        elif name == 'getmotors':
+            return self.getMotors()
+        elif name == 'geterr':
+            return (self.error + '\r\n') if self.error else ''
+        elif name == 'getversion':
+            return self.getVersion()
+        elif name == 'getldsscan':
+            return self.getLDSScan()
+        elif name == 'getanalogsensors':
+            return self.getAnalogSensors()
+        elif name == 'getdigitalsensors':
+            return self.getDigitalSensors()
+        elif name == 'clean':
+            if args[:1] == ['stop']:
+                self.cleaning = False
+                self.cleanRequested = False
+            else:
+                self.cleanRequested = True
+                self.error = ERROR_UNPLUG_USB
+            return ''
+        elif name == 'testmode':
+            self.testMode = args[:1] == ['on']
+            return ''
+        elif name == 'setldsrotation':
+            if not self.testMode:
+                return 'TestMode must be on to use this command.\r\n'
+            self.ldsRotating = args[:1] == ['on']
+            return ''
+        elif name == 'playsound':
+            return ''
+        return "Unknown Cmd: '" + cmd + "'\r\n"
+
+    def getCharger(self):
+        """Return GetCharger body."""
+        charging = self.docked and self.fuel < 100
+        rows = [('FuelPercent', int(self.fuel)),
+                ('BatteryOverTemp', 0),
+                ('ChargingActive', int(charging)),
+                ('ChargingEnabled', 1),
+                ('ConfidentOnFuel', 1),
+                ('OnReservedFuel', int(self.fuel < 10)),
+                ('EmptyFuel', int(self.fuel <= 0)),
+                ('BatteryFailure', 0),
+                ('ExtPwrPresent', int(self.docked)),
+                ('ThermistorPresent[0]', 1),
+                ('ThermistorPresent[1]', 1),
+                ('BattTempCAvg[0]', 27),
+                ('BattTempCAvg[1]', 26),
+                ('VBattV', '%.2f' % (14.0 + 2.5 * self.fuel / 100)),
+                ('VExtV', '22.41' if self.docked else '0.00'),
+                ('Charger_mAH', 1200 if charging else 0),
+                ('Discharge_mAH', 0 if self.docked else 900)]
+        return table('Label,Value', rows)
+
+    def getMotors(self):
+        """Return GetMotors body."""
+        speed = CLEANING_SPEED if self.cleaning else 0
+        rows = [('Brush_RPM', 1200 if self.cleaning else 0),
+                ('Brush_mA', 350 if self.cleaning else 0),
+                ('Vacuum_RPM', 8000 if self.cleaning else 0),
+                ('Vacuum_mA', 600 if self.cleaning else 0),
+                ('LeftWheel_RPM', 40 if self.cleaning else 0),
+                ('LeftWheel_Load%', 20 if self.cleaning else 0),
+                ('LeftWheel_PositionInMM', int(self.leftWheel)),
+                ('LeftWheel_Speed', speed),
+                ('RightWheel_RPM', 40 if self.cleaning else 0),
+                ('RightWheel_Load%', 20 if self.cleaning else 0),
+                ('RightWheel_PositionInMM', int(self.rightWheel)),
+                ('RightWheel_Speed', speed),
+                ('SideBrush_mA', 100 if self.cleaning else 0)]
+        return table('Parameter,Value', rows)
+
+    def getVersion(self):
+        """Return GetVersion body."""
+        rows = [('ModelID', '-1,XV28,'),
+                ('ConfigID', '1,,'),
+                ('Serial Number', self.serial_number + ',0000001,P'),
+                ('Software', '3,1,17031'),
+                ('MainBoard Software', '3,1,17031'),
+                ('BatteryType', '1,NIMH_12CELL,'),
+                ('BlowerType', '1,BLOWER_ORIG,'),
+                ('LDS Software', 'V2.6.15295,0000000001,'),
+                ('MainBoard Vendor ID', '543,,')]
+        return table('Component,Major,Minor,Build', rows)
+
+    def getAnalogSensors(self):
+        """Return GetAnalogSensors body, in the firmware 3.x layout."""
+        rows = [('BatteryVoltage', 'mV,%d,' % (14000 + 25 * self.fuel)),
+                ('BatteryCurrent', 'mA,%d,' % (-900 if self.cleaning
+                                               else 1200 if self.docked
+                                               else -50)),
+                ('BatteryTemperature', 'mC,%d,' % 27000),
+                ('ExternalVoltage', 'mV,%d,' % (22410 if self.docked
+                                                else 0)),
+                ('AccelerometerX', 'mG,%d,' % self.random.randint(-20, 20)),
+                ('AccelerometerY', 'mG,%d,' % self.random.randint(-20, 20)),
+                ('AccelerometerZ', 'mG,%d,' % (1000 +
+                                               self.random.randint(-20, 20))),
+                ('VacuumCurrent', 'mA,%d,' % (600 if self.cleaning else 0)),
+                ('SideBrushCurrent', 'mA,%d,' % (100 if self.cleaning
+                                                 else 0)),
+                ('MagSensorLeft', 'VAL,0,'),
+                ('MagSensorRight', 'VAL,0,'),
+                ('WallSensor', 'mm,%d,' % 60),
+                ('DropSensorLeft', 'mm,%d,' % 0),
+                ('DropSensorRight', 'mm,%d,' % 0)]
+        return table('SensorName,Unit,Value', rows)
+
+    def getDigitalSensors(self):
+        """Return GetDigitalSensors body."""
+        rows = [('SNSR_DC_JACK_IS_IN', 0),
+                ('SNSR_DUSTBIN_IS_IN', 1),
+                ('SNSR_LEFT_WHEEL_EXTENDED', 0),
+                ('SNSR_RIGHT_WHEEL_EXTENDED', 0),
+                ('LSIDEBIT', 0),
+                ('LFRONTBIT', 0),
+                ('RSIDEBIT', 0),
+                ('RFRONTBIT', 0)]
+        return table('Digital Sensor Name, Value', rows)
+
+    def getLDSScan(self):
+        """Return GetLDSScan body with the distances to the room walls."""
+        lines = ['AngleInDegrees,DistInMM,Intensity,ErrorCodeHEX']
+        for angle in range(360):
+            if not self.ldsRotating:
+                lines.append('%d,0,0,8035' % angle)
+                continue
+            theta = self.heading + math.radians(angle)
+            distance = wall_distance(self.x, self.y, theta)
+            if distance > 5000 or self.random.random() < 0.03:
+                lines.append('%d,0,0,8035' % angle)
+            else:
+                distance += self.random.gauss(0, 10)
+                lines.append('%d,%d,%d,0' % (angle, max(1, distance),
+                                             self.random.randint(100, 1500)))
+        lines.append('ROTATION_SPEED,%.2f' % self.random.uniform(4.9, 5.1))
+        return '\r\n'.join(lines) + '\r\n'
+
+
+def table(header, rows):
+    """Format rows of label and value as a response table."""
+    return header + '\r\n' + ''.join(
+        str(label) + ',' + str(value) + '\r\n' for label, value in rows)
+
+
+def wall_distance(x, y, theta):
+    """Return the distance from x, y along theta to the walls of the room."""
+    distances = []
+    dx, dy = math.cos(theta), math.sin(theta)
+    if dx > 1e-9:
+        distances.append((ROOM_WIDTH / 2 - x) / dx)
+    elif dx < -1e-9:
+        distances.append((-ROOM_WIDTH / 2 - x) / dx)
+    if dy > 1e-9:
+        distances.append((ROOM_DEPTH / 2 - y) / dy)
+    elif dy < -1e-9:
+        distances.append((-ROOM_DEPTH / 2 - y) / dy)
+    return min(distances)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds before each response')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='random extra seconds before each response')
+    parser.add_argument('--noise', type=float, default=0.0,
+                        help='probability a response has a corrupted byte')
+    parser.add_argument('--drop', type=float, default=0.0,
+                        help='probability a response is not sent at all')
+    parser.add_argument('--unplug-gap', type=float, default=1.0,
+                        help='seconds of silence that count as USB toggle')
+    parser.add_argument('--sleep-after', type=float, default=None,
+                        help='ignore the first command after this many '
+                             'idle seconds, like a robot that dozed off')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for reproducible noise and drops')
+    parser.add_argument('--serial-number', default='SIM00000AA',
+                        help='serial number to report, to tell several '
+                             'simulated robots apart')
+    parser.add_argument('--link', default=None,
+                        help='also make the device available at this path')
+    args = parser.parse_args()
+    sim = NeatoSimulator(args.latency, args.jitter, args.noise, args.drop,
+                         args.unplug_gap, args.sleep_after, args.seed,
+                         args.serial_number)
+    port = sim.start()
+    if args.link:
+        if os.path.lexists(args.link):
+            os.remove(args.link)
+        os.symlink(port, args.link)
+    print("Simulated Neato at " + (args.link or port) + ". Ctrl-C to quit.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+        if args.link and os.path.islink(args.link):
+            os.remove(args.link)
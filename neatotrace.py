@@ -0,0 +1,256 @@
+"""Wire-level trace of the serial connection to Neato in a ring file.
+
+Every command written and every response read is recorded with its time,
+direction, command, raw bytes and latency in a fixed-size memory-mapped
+file, so only the last trace_size_mb are kept and recording costs a copy
+into memory. The trace is frozen (no longer written) when something went
+wrong, like error 220 or a reconnect, so it still shows what led up to it.
+Decode it with:
+
+    python3 neatotrace.py /var/tmp/neato.trace
+"""
+import argparse
+import datetime
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'NTRC'
+VERSION = 1
+# magic, version, flags, capacity, head, tail, records in the ring,
+# records written in total
+HEADER = struct.Struct('<4sHHIIIIQ')
+HEADER_SIZE = 64
+# record size, time, direction, command length, latency, data length
+RECORD = struct.Struct('<IdBxHfI')
+# record size 0 marks the end of the data before the ring wraps
+WRAP = struct.Struct('<I')
+
+FROZEN = 1
+
+TX = 0
+RX = 1
+EVENT = 2
+DIRECTIONS = {TX: 'tx', RX: 'rx', EVENT: 'event'}
+
+
+def align(size):
+    """Round size up to a multiple of 8."""
+    return (size + 7) & ~7
+
+
+class WireTrace:
+    """Fixed-size ring of serial exchanges in a memory-mapped file.
+
+        trace = WireTrace('/var/tmp/neato.trace', 4 * 1024 * 1024)
+        trace.record(TX, 'GetCharger', b'GetCharger\\n')
+        trace.record(RX, 'GetCharger', response, latency)
+        trace.freeze('error 220')
+
+    A trace found frozen when opened for writing is moved aside to
+    path + '.frozen', so restarting does not overwrite it.
+    """
+
+    def __init__(self, path, size=None):
+        """Open or create the ring file of size bytes.
+
+        Without size, an existing trace is opened as it is, to read it.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        if size is None:
+            size = os.path.getsize(path)
+        else:
+            size = max(int(size), HEADER_SIZE + 4096)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    header = f.read(HEADER.size)
+                if (len(header) == HEADER.size and header[:4] == MAGIC and
+                        HEADER.unpack(header)[2] & FROZEN):
+                    os.replace(path, path + '.frozen')
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.capacity = size - HEADER_SIZE
+        (magic, version, self.flags, capacity, self.head, self.tail,
+         self.count, self.total) = HEADER.unpack_from(self.map, 0)
+        if (magic != MAGIC or version != VERSION or
+                capacity != self.capacity):
+            self.flags = self.head = self.tail = self.count = self.total = 0
+            self.writeHeader()
+
+    def writeHeader(self):
+        """Write the ring state to the header."""
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.flags,
+                         self.capacity, self.head, self.tail, self.count,
+                         self.total)
+
+    def readFlags(self):
+        """Return the flags in the header, another process may change them.
+
+        neatotrace.py --thaw clears FROZEN in the file of a running service.
+        """
+        self.flags = HEADER.unpack_from(self.map, 0)[2]
+        return self.flags
+
+    @property
+    def frozen(self):
+        """Return if recording has stopped."""
+        return bool(self.readFlags() & FROZEN)
+
+    def sizeAt(self, pos):
+        """Return the size of the record at pos, 0 at the wrap marker."""
+        if pos + RECORD.size > self.capacity:
+            return 0
+        return WRAP.unpack_from(self.map, HEADER_SIZE + pos)[0]
+
+    def evict(self):
+        """Drop the oldest record."""
+        self.tail += self.sizeAt(self.tail)
+        self.count -= 1
+        if self.count and self.sizeAt(self.tail) == 0:
+            self.tail = 0
+
+    def record(self, direction, command, data=b'', latency=0.0):
+        """Append a record, dropping the oldest ones to make room.
+
+        data can be any bytes-like object, like a memoryview on the
+        receive buffer, and is copied straight into the ring.
+        """
+        if self.readFlags() & FROZEN:
+            return
+        name = command.encode('utf-8', 'replace')[:0xffff]
+        # a record never takes more than half the ring
+        room = self.capacity // 2 - RECORD.size - len(name)
+        if len(data) > room:
+            data = data[:room]
+        need = align(RECORD.size + len(name) + len(data))
+        with self.lock:
+            if self.head + need > self.capacity:
+                # records from head to the end are the oldest, drop them
+                while self.count and self.tail >= self.head:
+                    self.evict()
+                if self.head + WRAP.size <= self.capacity:
+                    WRAP.pack_into(self.map, HEADER_SIZE + self.head, 0)
+                self.head = 0
+                if not self.count:
+                    self.tail = 0
+            while self.count and self.head <= self.tail < self.head + need:
+                self.evict()
+            pos = HEADER_SIZE + self.head
+            RECORD.pack_into(self.map, pos, need, time.time(), direction,
+                             len(name), latency, len(data))
+            pos += RECORD.size
+            self.map[pos:pos + len(name)] = name
+            pos += len(name)
+            self.map[pos:pos + len(data)] = data
+            if not self.count:
+                self.tail = self.head
+            self.head += need
+            self.count += 1
+            self.total += 1
+            self.writeHeader()
+
+    def freeze(self, reason):
+        """Record why and stop recording, keeping the trace as it is."""
+        if self.readFlags() & FROZEN:
+            return
+        self.record(EVENT, 'freeze', reason.encode('utf-8'))
+        with self.lock:
+            self.flags |= FROZEN
+            self.writeHeader()
+            self.map.flush()
+
+    def thaw(self):
+        """Start recording again."""
+        with self.lock:
+            self.flags &= ~FROZEN
+            self.writeHeader()
+
+    def records(self):
+        """Return a list of (time, direction, command, data, latency).
+
+        The oldest record comes first.
+        """
+        result = []
+        with self.lock:
+            pos = self.tail
+            for i in range(self.count):
+                if self.sizeAt(pos) == 0:
+                    pos = 0
+                (size, stamp, direction, name_length, latency,
+                 data_length) = RECORD.unpack_from(self.map, HEADER_SIZE + pos)
+                start = HEADER_SIZE + pos + RECORD.size
+                name = self.map[start:start + name_length].decode(
+                    'utf-8', 'replace')
+                start += name_length
+                data = bytes(self.map[start:start + data_length])
+                result.append((stamp, DIRECTIONS.get(direction, 'event'),
+                               name, data, latency))
+                pos += size
+        return result
+
+    def close(self):
+        """Flush and close the ring file."""
+        self.map.flush()
+        self.map.close()
+
+
+def open_trace(config):
+    """Return the WireTrace configured in the serial settings, or None."""
+    if not config.get('trace_file'):
+        return None
+    return WireTrace(config['trace_file'],
+                     float(config.get('trace_size_mb', 4)) * 1024 * 1024)
+
+
+def format_data(data):
+    """Return data as text, with control characters escaped."""
+    return (data.decode('latin-1').encode('unicode_escape')
+            .decode('ascii').replace('\\x1a', '^Z'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('--json', action='store_true',
+                        help='print one JSON object per record')
+    parser.add_argument('--max-bytes', type=int, default=None,
+                        help='only print this many bytes of every record')
+    parser.add_argument('--thaw', action='store_true',
+                        help='start recording again after a freeze')
+    args = parser.parse_args()
+
+    with open(args.path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            parser.error(args.path + ' is not a trace file')
+    trace = WireTrace(args.path)
+    if args.thaw:
+        trace.thaw()
+        print('Thawed ' + args.path)
+    else:
+        print('# %d records kept of %d written%s' % (
+            trace.count, trace.total, ', frozen' if trace.frozen else ''))
+        for stamp, direction, command, data, latency in trace.records():
+            if args.max_bytes is not None:
+                data = data[:args.max_bytes]
+            when = datetime.datetime.fromtimestamp(stamp).isoformat(
+                timespec='milliseconds')
+            if args.json:
+                print(json.dumps({'time': stamp, 'direction': direction,
+                                  'command': command,
+                                  'latency_ms': latency * 1000,
+                                  'data': format_data(data)}))
+            else:
+                print('%s %-5s %-18s %8.1f ms %6d B  %s' % (
+                    when, direction, command, latency * 1000, len(data),
+                    format_data(data)))
+    trace.close()
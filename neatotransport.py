@@ -0,0 +1,331 @@
+"""Transports underneath NeatoSerial: serial, record and replay.
+
+A transport finds the devices Neato might be connected to and opens them
+as ports with the part of the pyserial interface NeatoSerial uses. Besides
+the serial port, a session can be recorded to a file, one JSON object per
+request and response, and replayed from it later without a robot, as it
+was recorded or faster:
+
+    ns = NeatoSerial(config, ReplayTransport('session.jsonl', speed=10))
+
+Print a recorded session with:
+
+    python3 neatotransport.py session.jsonl
+"""
+import argparse
+import collections
+import json
+import logging
+import threading
+import time
+import serial
+from serial.tools import list_ports
+
+# USB vendor and product id Neato XV robots enumerate with
+NEATO_USB_VID = 0x2108
+NEATO_USB_PID = 0x780b
+
+
+def usb_id(value):
+    """Convert a USB id from the config, like 0x2108 or '2108', to an int."""
+    if isinstance(value, int):
+        return value
+    return int(str(value), 16)
+
+
+def find_devices(config):
+    """Return the devices Neato might be connected to, most likely first.
+
+    Serial ports with Neato's USB vendor and product id (and serial number,
+    if configured) come first, so a Neato that enumerated under another
+    ttyACM after a USB toggle is found right away. The devices configured in
+    serial_device follow. With usb_discovery off, only those are tried.
+    """
+    devices = []
+    if config.get('usb_discovery', True):
+        vid = usb_id(config.get('usb_vid', NEATO_USB_VID))
+        pid = usb_id(config.get('usb_pid', NEATO_USB_PID))
+        serial_number = config.get('usb_serial_number')
+        devices = [port.device for port in list_ports.comports()
+                   if port.vid == vid and port.pid == pid and
+                   (not serial_number or
+                    port.serial_number == serial_number)]
+    for dev in str(config.get('serial_device') or '').split(','):
+        dev = dev.strip()
+        if dev and dev not in devices:
+            devices.append(dev)
+    return devices
+
+
+def encode(data):
+    """Return bytes as a string that survives JSON unchanged."""
+    return bytes(data).decode('latin-1')
+
+
+def decode(text):
+    """Return the bytes of a string made by encode()."""
+    return text.encode('latin-1')
+
+
+class SerialTransport:
+    """Open the serial ports Neato is connected to."""
+
+    def __init__(self, config):
+        """Initialize transport with the serial settings."""
+        self.config = config
+
+    def devices(self):
+        """Return the devices to try, most likely first."""
+        return find_devices(self.config)
+
+    def open(self, device):
+        """Open device and return it as a port."""
+        return serial.Serial(device, 115200,
+                             serial.EIGHTBITS, serial.PARITY_NONE,
+                             serial.STOPBITS_ONE,
+                             self.config['timeout_seconds'])
+
+
+class RecordingPort:
+    """Serial port that records every request and its response.
+
+    A request is everything written at once, its response everything read
+    until the next write, so a batch is recorded as one exchange.
+    """
+
+    def __init__(self, port, transport):
+        """Initialize port recording the exchanges on port to transport."""
+        self.port = port
+        self.transport = transport
+        self.request = None
+        self.response = bytearray()
+        self.sent = None
+        self.last = None
+
+    @property
+    def timeout(self):
+        return self.port.timeout
+
+    def write(self, data):
+        """Write data to the port, starting a new exchange."""
+        self.finish()
+        self.request = bytes(data)
+        self.sent = self.last = time.perf_counter()
+        return self.port.write(data)
+
+    def readinto(self, b):
+        """Read into b from the port and record what was read."""
+        n = self.port.readinto(b)
+        if n and self.request is not None:
+            self.response += b[:n]
+            self.last = time.perf_counter()
+        return n
+
+    def inWaiting(self):
+        return self.port.inWaiting()
+
+    def isOpen(self):
+        return self.port.isOpen()
+
+    def flushInput(self):
+        self.port.flushInput()
+
+    def finish(self):
+        """Record the current exchange, if any."""
+        if self.request is not None:
+            self.transport.record(self.request, self.response,
+                                  self.last - self.sent)
+            self.request = None
+            self.response = bytearray()
+
+    def close(self):
+        """Record the current exchange and close the port."""
+        self.finish()
+        self.port.close()
+
+
+class RecordTransport(SerialTransport):
+    """Open serial ports and record everything said on them to a file."""
+
+    def __init__(self, config, path):
+        """Initialize transport recording to path, replacing its content."""
+        super().__init__(config)
+        self.path = path
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        # line buffered, a recording is complete up to the last exchange
+        self.file = open(path, 'w', buffering=1)
+
+    def open(self, device):
+        """Open device and return it as a recording port."""
+        return RecordingPort(super().open(device), self)
+
+    def record(self, request, response, latency):
+        """Append an exchange to the recording."""
+        line = json.dumps({'time': round(time.monotonic() - self.start, 6),
+                           'request': encode(request),
+                           'response': encode(response),
+                           'latency': round(latency, 6)})
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def close(self):
+        """Close the recording."""
+        with self.lock:
+            self.file.close()
+
+
+def load(path):
+    """Return the exchanges in a recording, oldest first.
+
+    Every exchange is a (time, request, response, latency) tuple.
+    """
+    exchanges = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            exchange = json.loads(line)
+            exchanges.append((exchange['time'], decode(exchange['request']),
+                              decode(exchange['response']),
+                              exchange['latency']))
+    return exchanges
+
+
+class ReplayPort:
+    """Port that answers requests with the responses of a recording."""
+
+    def __init__(self, transport, timeout):
+        """Initialize port answering from transport."""
+        self.transport = transport
+        self.timeout = timeout
+        self.pending = b''
+        self.ready = 0.0
+        self.closed = False
+
+    def write(self, data):
+        """Look up the response to data, dropping any unread one."""
+        if self.closed:
+            raise serial.SerialException('Port is closed')
+        self.pending, latency = self.transport.respond(bytes(data))
+        speed = self.transport.speed
+        self.ready = time.monotonic() + (latency / speed if speed else 0)
+        return len(data)
+
+    def inWaiting(self):
+        """Return the bytes of the response that can be read."""
+        if time.monotonic() < self.ready:
+            return 0
+        return len(self.pending)
+
+    def readinto(self, b):
+        """Read the response into b once its latency passed.
+
+        Like a serial port, waits at most the timeout for it.
+        """
+        wait = self.ready - time.monotonic()
+        if wait > 0:
+            time.sleep(min(wait, self.timeout))
+            if time.monotonic() < self.ready:
+                return 0
+        if not self.pending:
+            time.sleep(self.timeout)
+            return 0
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def isOpen(self):
+        return not self.closed
+
+    def flushInput(self):
+        self.pending = b''
+
+    def close(self):
+        self.closed = True
+
+
+class ReplayTransport:
+    """Replay a recording instead of talking to Neato.
+
+    Every request is answered with the next response recorded for it, so
+    the order of different requests may change, e.g. when a poller asks
+    for less because time passes faster. Responses come after their
+    recorded latency divided by speed, immediately with a speed of 0. Once
+    all responses to a request were used they start over, unless loop is
+    False, then it goes unanswered like on a dead link.
+    """
+
+    def __init__(self, path, speed=1.0, loop=True, timeout=0.1):
+        """Initialize transport from the recording in path.
+
+        timeout is the read timeout of the ports, like timeout_seconds.
+        """
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.recorded = collections.defaultdict(list)
+        for stamp, request, response, latency in load(path):
+            self.recorded[request].append((response, latency))
+        self.responses = {request: collections.deque(answers)
+                          for request, answers in self.recorded.items()}
+
+    def devices(self):
+        """Return the recording as the only device."""
+        return [self.path]
+
+    def open(self, device):
+        """Return a port replaying the recording.
+
+        All ports share the position in the recording, so it carries on
+        after a reconnect.
+        """
+        return ReplayPort(self, self.timeout)
+
+    def respond(self, request):
+        """Return the next response to request and its latency."""
+        with self.lock:
+            answers = self.responses.get(request)
+            if not answers and self.loop and request in self.recorded:
+                answers = self.responses[request] = collections.deque(
+                    self.recorded[request])
+            if not answers:
+                self.log.debug("No recorded response to "+repr(request))
+                return b'', 0.0
+            return answers.popleft()
+
+    def close(self):
+        pass
+
+
+def open_transport(config):
+    """Return the transport configured in the serial settings."""
+    kind = config.get('transport', 'serial')
+    if kind == 'serial':
+        return SerialTransport(config)
+    elif kind == 'record':
+        return RecordTransport(config, config['transport_file'])
+    elif kind == 'replay':
+        return ReplayTransport(config['transport_file'],
+                               float(config.get('replay_speed', 1)),
+                               bool(config.get('replay_loop', True)),
+                               float(config.get('timeout_seconds', 0.1)))
+    raise ValueError("Unknown transport: "+str(kind))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print a recorded session.')
+    parser.add_argument('path')
+    parser.add_argument('--max-bytes', type=int, default=None,
+                        help='only print this many bytes of every response')
+    args = parser.parse_args()
+
+    for stamp, request, response, latency in load(args.path):
+        if args.max_bytes is not None:
+            response = response[:args.max_bytes]
+        print('%10.3f %8.1f ms  %r -> %r' % (stamp, latency * 1000,
+                                             request, response))
@@ -0,0 +1,98 @@
+"""Single-owner worker thread for the serial connection to Neato."""
+import contextlib
+import itertools
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+# lower runs first
+PRIORITY_COMMAND = 0
+PRIORITY_TELEMETRY = 10
+
+
+class SerialWorker:
+    """Run everything that talks to Neato on one thread.
+
+    Jobs are taken from a priority queue, so user commands like Clean
+    overtake telemetry polls that are still waiting. Every job returns a
+    concurrent.futures.Future:
+
+        worker = SerialWorker(ns)
+        worker.start()
+        worker.write("Clean").add_done_callback(...)
+        level = worker.submit(NeatoSerial.getBatteryLevel,
+                              key="battery_level").result()
+    """
+
+    def __init__(self, neato):
+        """Initialize worker owning a NeatoSerial instance."""
+        self.log = logging.getLogger(__name__)
+        self.neato = neato
+        self.queue = queue.PriorityQueue()
+        self.order = itertools.count()
+        # key -> future of the pending job, to coalesce duplicates
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.cycle = None
+        self.cycleContext = contextlib.ExitStack()
+        self.thread = None
+
+    def start(self):
+        """Start the worker thread."""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """Finish the queued jobs and stop the worker thread."""
+        # sorts after every real job
+        self.queue.put((float('inf'), next(self.order), None, None, None,
+                        None))
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def submit(self, func, priority=PRIORITY_TELEMETRY, key=None,
+               cycle=None):
+        """Queue func(neato) and return a future for its result.
+
+        While a job with the same key is still waiting, its future is
+        returned instead of queueing a duplicate. Consecutive jobs of the
+        same cycle share one NeatoSerial.poll() snapshot.
+        """
+        with self.lock:
+            if key is not None and key in self.pending:
+                return self.pending[key]
+            future = Future()
+            if key is not None:
+                self.pending[key] = future
+            self.queue.put((priority, next(self.order), func, key, cycle,
+                            future))
+        return future
+
+    def write(self, msg, priority=PRIORITY_COMMAND):
+        """Queue a command and return a future for its output."""
+        return self.submit(lambda neato: neato.write(msg), priority)
+
+    def run(self):
+        """Run jobs until stopped."""
+        while True:
+            priority, order, func, key, cycle, future = self.queue.get()
+            if func is None:
+                break
+            with self.lock:
+                if key is not None:
+                    self.pending.pop(key, None)
+            if not future.set_running_or_notify_cancel():
+                continue
+            if cycle != self.cycle:
+                self.cycleContext.close()
+                if cycle is not None:
+                    self.cycleContext.enter_context(self.neato.poll())
+                self.cycle = cycle
+            try:
+                future.set_result(func(self.neato))
+            except Exception as ex:
+                self.log.error("Exception in serial job: "+str(ex))
+                future.set_exception(ex)
+        self.cycleContext.close()